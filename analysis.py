@@ -0,0 +1,243 @@
+"""
+Behavioural analysis of the MID results of all subjects at once.
+
+Every part saved under the results tree is loaded into one table (the columnar .npy of the part when there is one,
+otherwise its .txt, including the shorter results files of previous versions), and each measure is computed for all
+subjects in one pass with vectorized pandas/NumPy operations:
+
+    learning_curves       Share of choices of each chest (by reward probability) per condition and block of trials
+    switch_accuracy       Choices of the best and of the previously best chest around the learn -> reverse switch
+    win_stay_lose_shift   P(stay) after a win and P(shift) after a loss per subject and condition
+    confidence_calibration  Hit rate and reward probability of the chosen chest per confidence level
+    latency_stats         Distribution of the chest and confidence latencies per subject and condition
+    fit_q_learning        Rescorla-Wagner / Q-learning (softmax) fit per subject, grid search over alpha and beta
+
+    python analysis.py [results_dir] [--output results_dir/analysis]
+"""
+import os, re, time, argparse
+import numpy as np
+import pandas as pd
+from mid import RESULTS_COLUMNS
+
+COND_ORDER = {'test': 0, 'learn': 1, 'refresh': 2, 'reverse': 3}
+CHESTS = ['reward_left', 'reward_down', 'reward_right']
+# Confidence keys, from '1' (Bastante) to '4' (Nada)
+CONFIDENCE_LEVELS = {1: 'Bastante', 2: 'Algo', 3: 'Poco', 4: 'Nada'}
+
+def find_parts(results_dir='results'):
+    # Results file of every part under results_dir: {base path: (subject_id, experiment_condition, experiment_part)}
+    parts = {}
+    for folder, _, names in os.walk(results_dir):
+        for name in names:
+            match = re.fullmatch(r'(.+)_([AB])_part_(\d+)\.(txt|npy)', name)
+            if match:
+                parts[os.path.join(folder, name[:-4])] = (match.group(1), match.group(2), int(match.group(3)))
+    return dict(sorted(parts.items()))
+
+def read_text_part(results_file, subject_id, experiment_condition, experiment_part):
+    # A .txt results file as a table with the columns of the .npy files (columns missing in older versions are NaN)
+    part = pd.read_csv(results_file, sep=';')
+    rewards = part['trial_setup'].astype(str).str.extract(r'(\d)\D+(\d)\D+(\d)').astype(int)
+    rewards.columns = CHESTS
+    part = pd.concat([part.drop(columns='trial_setup'), rewards], axis=1)
+    return part.assign(subject=subject_id, experiment_condition=experiment_condition, experiment_part=experiment_part)
+
+def load_trials(results_dir='results'):
+    """
+    One row per trial of every subject and part under results_dir, in the order the trials ran, with the reward
+    probability of each chest (p_left, p_down, p_right: the reward ratio of the chest in the learning or reverse 
+    schedule, which generate_trials makes exact; refresh trials use the learning one), of the chosen chest (chosen_p)
+    and whether it was the best chest (best). They are NaN for the test trials.
+    """
+    tables = []
+    for base, (subject_id, experiment_condition, experiment_part) in find_parts(results_dir).items():
+        if os.path.exists(base + '.npy'):
+            tables.append(pd.DataFrame(np.load(base + '.npy', allow_pickle=False)))
+        else:
+            tables.append(read_text_part(base + '.txt', subject_id, experiment_condition, experiment_part))
+    columns = ['subject', 'experiment_condition', 'experiment_part'] + [c for c in RESULTS_COLUMNS if c != 'trial_setup'] + CHESTS
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    trials = pd.concat(tables, ignore_index=True)
+    trials['subject'] = trials['subject'].astype(str)
+    trials['cond_order'] = trials['cond'].map(COND_ORDER)
+    trials = trials.sort_values(['subject', 'experiment_part', 'cond_order', 'trial_n'], kind='stable').reset_index(drop=True)
+
+    # Reward probability of each chest and of the chosen one
+    schedule = trials['cond'].replace({'refresh': 'learn'})
+    rewards = trials[CHESTS].where(trials['cond'] != 'refresh')
+    p = rewards.groupby([trials['subject'], schedule], sort=False).transform('mean').to_numpy()
+    p[trials['cond'] == 'test'] = np.nan
+    trials['p_left'], trials['p_down'], trials['p_right'] = p.T
+    trials['chosen_p'] = np.take_along_axis(p, trials[['chest_sel']].to_numpy(dtype=int), axis=1)[:, 0]
+    trials['best'] = (trials['chosen_p'] == p.max(axis=1)).where(trials['cond'] != 'test')
+    return trials
+
+def learning_curves(trials, block_size=10):
+    # Share of choices of each chest (columns: reward probability) per condition and block of trial_n, mean over subjects
+    learning = trials[trials['cond'] != 'test']
+    block = (learning['trial_n'] - 1) // block_size + 1
+    choices = pd.get_dummies(learning['chosen_p'].round(2)).astype(float)
+    per_subject = choices.groupby([learning['cond'], block, learning['subject']]).mean()
+    curves = per_subject.groupby(level=[0, 1]).mean()
+    curves.index.names = ['cond', 'block']
+    curves.columns = [f"p_{round(100 * p)}" for p in curves.columns]
+    return curves.sort_index(key=lambda index: index.map(COND_ORDER) if index.name == 'cond' else index)
+
+def switch_accuracy(trials, window=10):
+    """
+    Around the switch from the learning to the reverse learning schedule (the refresh trials before it, the reverse
+    trials after it): share of subjects choosing the best chest, and the chest that was best before the switch, at
+    each trial relative to the switch (-1 is the last refresh trial, 1 the first reverse trial).
+    """
+    around = trials[trials['cond'].isin(['refresh', 'reverse'])]
+    n_refresh = around[around['cond'] == 'refresh'].groupby('subject')['trial_n'].transform('max')
+    relative = np.where(around['cond'] == 'reverse', around['trial_n'], around['trial_n'] - n_refresh.reindex(around.index).fillna(0) - 1)
+    # Position of the best chest in the learning schedule
+    learn = trials[trials['cond'] == 'learn']
+    old_best = learn.groupby('subject')[['p_left', 'p_down', 'p_right']].first().to_numpy().argmax(axis=1)
+    old_best = pd.Series(old_best, index=learn.groupby('subject').size().index)
+    around = around.assign(relative_trial=relative.astype(int),
+                           previous_best=around['chest_sel'].to_numpy() == old_best.reindex(around['subject']).to_numpy())
+    around = around[(around['relative_trial'] >= -window) & (around['relative_trial'] <= window)]
+    return around.groupby('relative_trial')[['best', 'previous_best']].mean()
+
+def win_stay_lose_shift(trials):
+    # P(same chest as the previous trial | previous won) and P(different chest | previous lost) per subject and condition
+    learning = trials[trials['cond'] != 'test']
+    groups = learning.groupby(['subject', 'experiment_part', 'cond'], sort=False)
+    previous_choice, previous_hit = groups['chest_sel'].shift(), groups['hit'].shift()
+    stay = (learning['chest_sel'] == previous_choice).astype(float)
+    rates = pd.DataFrame({'win_stay': stay.where(previous_hit == 1), 'lose_shift': (1 - stay).where(previous_hit == 0)})
+    return rates.groupby([learning['subject'], learning['cond']], sort=False).mean()
+
+def confidence_calibration(trials):
+    # Per condition and confidence level: trials, hit rate and mean reward probability of the chosen chest
+    learning = trials[trials['cond'] != 'test']
+    calibration = learning.groupby(['cond', learning['confidence_sel'].astype(int)]).agg(
+        n=('hit', 'size'), hit_rate=('hit', 'mean'), chosen_p=('chosen_p', 'mean'))
+    calibration.index.names = ['cond', 'confidence']
+    calibration['level'] = calibration.index.get_level_values('confidence').map(CONFIDENCE_LEVELS)
+    return calibration
+
+def latency_stats(trials, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    # Mean, standard deviation and quantiles of the chest and confidence latencies (ms) per subject and condition
+    # (latencies of 0, from simulations, are left out)
+    stats = []
+    for column in ['chest_latency_ms', 'confidence_latency_ms']:
+        latencies = trials[column].where(trials[column] > 0)
+        groups = latencies.groupby([trials['subject'], trials['cond']])
+        table = groups.quantile(list(quantiles)).unstack()
+        table.columns = [f"{column}_q{round(100 * q)}" for q in table.columns]
+        table.insert(0, f"{column}_sd", groups.std())
+        table.insert(0, f"{column}_mean", groups.mean())
+        stats.append(table)
+    return pd.concat(stats, axis=1)
+
+def session_arrays(trials):
+    # Choices and rewards (n_subjects, n_trials) of the learning, refresh and reverse trials in the order they ran,
+    # padded at the end, with the mask of the real trials
+    learning = trials[trials['cond'] != 'test']
+    subjects, subject_index = np.unique(learning['subject'].to_numpy(), return_inverse=True)
+    trial_index = learning.groupby('subject', sort=False).cumcount().to_numpy()
+    shape = (len(subjects), trial_index.max() + 1 if len(trial_index) else 0)
+    choices, rewards, mask = np.zeros(shape, dtype=int), np.zeros(shape), np.zeros(shape, dtype=bool)
+    choices[subject_index, trial_index] = learning['chest_sel'].to_numpy()
+    rewards[subject_index, trial_index] = learning['hit'].to_numpy()
+    mask[subject_index, trial_index] = True
+    return subjects, choices, rewards, mask
+
+def q_learning_loglik(choices, rewards, mask, alpha, beta, q0=0.5):
+    """
+    Log-likelihood of the choices of every subject under a Q-learning model with a softmax policy, for many parameter
+    sets at once. The only loop is over trials; subjects and parameters are array dimensions.
+
+        choices, rewards, mask (array): (n_subjects, n_trials), see session_arrays.
+        alpha, beta (array): Learning rates and inverse temperatures, (n_params,) or (n_subjects, n_params).
+
+    Returns an array (n_subjects, n_params).
+    """
+    n_subjects, n_trials = choices.shape
+    alpha = np.broadcast_to(alpha, (n_subjects, np.shape(alpha)[-1]))[..., None]
+    beta = np.broadcast_to(beta, (n_subjects, np.shape(beta)[-1]))[..., None]
+    # One-hot choices, all zero on the padding, so padded trials neither add to the likelihood nor update Q
+    chosen = (choices[..., None] == np.arange(3)) & mask[..., None]
+    chosen = chosen[:, :, None, :].astype(float)
+    q = np.full(alpha.shape[:2] + (3,), q0)
+    loglik = np.zeros(alpha.shape[:2])
+    for t in range(n_trials):
+        q_chosen = (q * chosen[:, t]).sum(axis=2, keepdims=True)
+        # log softmax of the chosen chest: -log(sum(exp(beta * (q - q_chosen))))
+        loglik -= mask[:, t, None] * np.log(np.exp(beta * (q - q_chosen)).sum(axis=2))
+        q += alpha * chosen[:, t] * (rewards[:, t, None, None] - q_chosen)
+    return loglik
+
+def q_values(choices, rewards, mask, alphas, q0=0.5):
+    # Q-values before every trial (n_subjects, n_alphas, n_trials, 3) for each learning rate. They don't depend on beta.
+    n_subjects, n_trials = choices.shape
+    chosen = ((choices[..., None] == np.arange(3)) & mask[..., None]).astype(float)
+    alphas = np.asarray(alphas)[None, :, None]
+    q = np.full((n_subjects, alphas.shape[1], 3), q0)
+    values = np.empty((n_subjects, alphas.shape[1], n_trials, 3))
+    for t in range(n_trials):
+        values[:, :, t] = q
+        q_chosen = (q * chosen[:, None, t]).sum(axis=2, keepdims=True)
+        q += alphas * chosen[:, None, t] * (rewards[:, t, None, None] - q_chosen)
+    return values
+
+def q_learning_grid_loglik(choices, rewards, mask, alphas, betas):
+    """
+    Log-likelihood (n_subjects, n_alphas, n_betas) of every alpha and beta of a grid. The Q-values are computed once
+    per learning rate, and each beta is then evaluated on all the trials at once: the log softmax of the chosen chest
+    is -log(1 + sum(exp(beta * (Q_other - Q_chosen)))) over the two other chests.
+    """
+    values = q_values(choices, rewards, mask, alphas)
+    others = (choices[..., None] + np.array([1, 2])) % 3
+    differences = (np.take_along_axis(values, others[:, None], axis=3)
+                   - np.take_along_axis(values, choices[:, None, :, None], axis=3))
+    loglik = np.empty((len(choices), len(alphas), len(betas)))
+    for j, beta in enumerate(betas):
+        loglik[:, :, j] = -(mask[:, None] * np.log1p(np.exp(beta * differences).sum(axis=3))).sum(axis=2)
+    return loglik
+
+def grid_search(choices, rewards, mask, alphas=np.linspace(0.02, 1, 30), betas=np.geomspace(0.1, 30, 30), chunk_size=100):
+    # Maximum likelihood alpha and beta of every subject over a grid, and their log-likelihood
+    # (subjects are evaluated in chunks, which keeps the arrays small enough to stay fast)
+    loglik = np.concatenate([q_learning_grid_loglik(choices[i:i + chunk_size], rewards[i:i + chunk_size], mask[i:i + chunk_size], alphas, betas)
+                             for i in range(0, len(choices), chunk_size)]).reshape(len(choices), -1)
+    alpha, beta = [grid.ravel() for grid in np.meshgrid(alphas, betas, indexing='ij')]
+    best = loglik.argmax(axis=1)
+    return alpha[best], beta[best], loglik[np.arange(len(choices)), best]
+
+def fit_q_learning(trials, alphas=np.linspace(0.02, 1, 30), betas=np.geomspace(0.1, 30, 30)):
+    # Grid search fit of every subject, with the log-likelihood and the BIC
+    subjects, choices, rewards, mask = session_arrays(trials)
+    alpha, beta, loglik = grid_search(choices, rewards, mask, alphas, betas)
+    n_trials = mask.sum(axis=1)
+    fits = pd.DataFrame({'alpha': alpha, 'beta': beta, 'loglik': loglik, 'n_trials': n_trials},
+                        index=pd.Index(subjects, name='subject'))
+    fits['bic'] = 2 * np.log(n_trials) - 2 * fits['loglik']
+    return fits
+
+def analyze(results_dir='results'):
+    # Every measure for all the subjects under results_dir
+    trials = load_trials(results_dir)
+    return {'learning_curves': learning_curves(trials), 'switch_accuracy': switch_accuracy(trials),
+            'win_stay_lose_shift': win_stay_lose_shift(trials), 'confidence_calibration': confidence_calibration(trials),
+            'latency_stats': latency_stats(trials), 'q_learning_fits': fit_q_learning(trials)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('results_dir', nargs='?', default='results')
+    parser.add_argument('--output', default=None, help='Folder for the tables (results_dir/analysis by default)')
+    args = parser.parse_args()
+    output = args.output or os.path.join(args.results_dir, 'analysis')
+
+    start = time.perf_counter()
+    tables = analyze(args.results_dir)
+    elapsed = time.perf_counter() - start
+    os.makedirs(output, exist_ok=True)
+    for name, table in tables.items():
+        table.to_csv(os.path.join(output, name + '.txt'), sep=';')
+    n_subjects = len(tables['q_learning_fits'])
+    print(f"{n_subjects} subjects analyzed in {elapsed:.2f} s, tables saved to {output}")
@@ -0,0 +1,108 @@
+"""
+Local stand-in for the BrainProducts Remote Control Server, to test RCSMarkerBackend without a Recorder.
+
+It speaks the part of the RCS protocol that the task uses (commands and replies separated by '\\r'): opening the
+Recorder, workspace, experiment, participant and amplifier, the modes, recording start/stop/pause/resume and
+annotations, and it reports the application, recording and acquisition states as the Recorder does. The annotations
+received are kept with their arrival time. To exercise the retries, drops and latency of the marker sender, it can be
+told to delay the reply to each annotation (stall) or to leave a fraction of them unanswered (drop), also while it runs.
+
+    python extras/benchmarks/fake_rcs.py [--port 6700] [--stall 0.0] [--drop 0.0]
+
+extras/benchmarks/marker_latency.py --fake-rcs runs the rcs backend against it.
+"""
+import sys, time, socket, argparse, threading
+import numpy as np
+
+# State messages sent after each command (besides the acknowledgement). Stopping a recording ('Q') reports no change:
+# RemoteControlServer.stopRecording waits for the recording state it had, and the task sets the default mode next.
+STATE_CHANGES = {'O': ['AP:1', 'RS:0', 'AQ:0'], 'M': ['RS:1', 'AQ:1'], 'SV': ['RS:0', 'AQ:0'], 'S': ['RS:4'],
+                 'P': ['RS:6'], 'C': ['RS:4'], 'X': ['RS:0', 'AQ:0', 'AP:0']}
+
+class FakeRCS:
+    """
+    Fake Remote Control Server listening on host:port (port 0 picks a free port, see `port`) in a background thread.
+    One client is served at a time.
+
+        stall (float): Seconds before each annotation is acknowledged.
+        drop (float): Fraction of the annotations that are never acknowledged.
+        seed (int): Seed for the drops.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, stall=0.0, drop=0.0, seed=None):
+        self.stall = stall
+        self.drop = drop
+        self.rng = np.random.default_rng(seed)
+        self.annotations = [] # (text, type, arrival time)
+        self.n_dropped = 0
+        self.commands = []
+        self.server = socket.create_server((host, port))
+        self.host, self.port = self.server.getsockname()[:2]
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                break
+            with connection:
+                self.handle(connection)
+
+    def handle(self, connection):
+        buffer = ''
+        while self.running:
+            try:
+                data = connection.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data.decode('utf-8')
+            *messages, buffer = buffer.split('\r')
+            for message in messages:
+                message = message.strip()
+                if message:
+                    for reply in self.reply(message):
+                        connection.sendall((reply + '\r').encode('utf-8'))
+
+    def reply(self, message):
+        # Replies to a command: its acknowledgement and the state changes it causes
+        self.commands.append(message)
+        if message.startswith('AN:'):
+            text, annot_type = message[3:].split(';', 1)
+            self.annotations.append((text, annot_type, time.perf_counter()))
+            if self.drop and self.rng.random() < self.drop:
+                self.n_dropped += 1
+                return []
+            if self.stall:
+                time.sleep(self.stall)
+            return [message + ':OK']
+        if message == 'VM':
+            return ['VM:2']
+        command = message.split(':')[0]
+        return [message + ':OK'] + STATE_CHANGES.get(command, [])
+
+    def close(self):
+        self.running = False
+        self.server.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6700)
+    parser.add_argument('--stall', type=float, default=0.0, help='Seconds before each annotation is acknowledged')
+    parser.add_argument('--drop', type=float, default=0.0, help='Fraction of the annotations never acknowledged')
+    args = parser.parse_args()
+
+    rcs = FakeRCS(args.host, args.port, args.stall, args.drop)
+    print(f"Fake RCS listening on {rcs.host}:{rcs.port} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(f"{len(rcs.annotations)} annotations received, {rcs.n_dropped} dropped")
+        rcs.close()
+        sys.exit()
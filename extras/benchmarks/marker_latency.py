@@ -0,0 +1,146 @@
+"""
+Marker-to-EEG latency of the MID task.
+
+Runs MID trials in simulation (synthetic participant, NullWindow paced at the refresh rate) while the BetaGenerator
+outlet from pylsl_examples/PerformanceTest.py streams synthetic EEG, and measures how far each marker is from the
+time it describes: the flip for markers sent through win.callOnFlip, the call otherwise.
+
+    lsl: the markers are read back from the 'MID_markers' stream through an inlet with proc_clocksync|proc_dejitter,
+         and the offset is marker timestamp - flip time.
+    rcs: (needs a Remote Control Server at RCSMarkerBackend.rcs_host/rcs_port, or --fake-rcs to start the one of
+         fake_rcs.py, which can delay (--rcs-stall) or leave unanswered (--rcs-drop) the annotations) RCS annotations 
+         get their time from the recorder when they arrive, so the offset is the time from the flip until the 
+         annotation was acknowledged. The markers sent, retried, failed and dropped are reported too.
+
+The p50/p95/p99 offsets per marker and backend are written to a JSON file, to compare versions.
+
+    python extras/benchmarks/marker_latency.py [--trials 20] [--backends lsl rcs] [--output marker_latency.json]
+    python extras/benchmarks/marker_latency.py --backends rcs --fake-rcs [--rcs-stall 0.05] [--rcs-drop 0.1]
+"""
+import os, sys, json, time, argparse, tempfile, threading, subprocess
+import numpy as np
+from pylsl import StreamInlet, resolve_byprop, local_clock, proc_clocksync, proc_dejitter
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.join(root_dir, 'extras', 'pylsl_examples'))
+from mid import MonetaryIncentiveDelayTask, QLearningResponder, NullWindow, FrameScheduler, RCSMarkerBackend, MARKER_CODES
+from PerformanceTest import BetaGeneratorOutlet
+from fake_rcs import FakeRCS
+
+def run_trials(backend, n_trials, refresh_rate, results_dir):
+    # Simulated task with a real marker backend and a window paced on the LSL clock
+    task = MonetaryIncentiveDelayTask('bench', 'A', 1, QLearningResponder(seed=0), results_dir, seed_value=1, marker_backend=backend)
+    task.win = NullWindow(refresh_rate, paced=True, clock=local_clock)
+    task.scheduler = FrameScheduler(task.win)
+    task.eeg_interface.debug = False
+    task.eeg_interface.eeg_connect('bench', 'A', 1)
+    inlet = None
+    if backend == 'lsl':
+        streams = resolve_byprop('name', task.eeg_interface.backend.stream_name, timeout=5)
+        inlet = StreamInlet(streams[0], processing_flags=proc_clocksync | proc_dejitter)
+        inlet.open_stream(timeout=5)
+        time.sleep(0.5)
+
+    # Reference time of every marker: the flip for markers registered with callOnFlip, the call for the others
+    references = []
+    flip_time = [None]
+    send_marker = task.eeg_interface.eeg_send_marker
+    call_on_flip = task.win.callOnFlip
+    def record_marker(text, *args, **kwargs):
+        references.append((text, local_clock() if flip_time[0] is None else flip_time[0]))
+        send_marker(text, *args, **kwargs)
+    def record_flip(function, *args, **kwargs):
+        def at_flip():
+            flip_time[0] = task.win.time
+            function(*args, **kwargs)
+            flip_time[0] = None
+        call_on_flip(at_flip)
+    task.eeg_interface.eeg_send_marker = record_marker
+    task.win.callOnFlip = record_flip
+
+    task.eeg_interface.eeg_start_recording()
+    for i in range(n_trials):
+        task.run_trial('learn', i + 1)
+    task.eeg_interface.eeg_stop_recording()
+    task.save_results()
+
+    names = [text for text, _ in references]
+    reference_times = np.array([t for _, t in references])
+    if backend == 'lsl':
+        codes, timestamps = [], []
+        while len(timestamps) < len(references):
+            samples, times = inlet.pull_chunk(timeout=1.0)
+            if not times:
+                break
+            codes += [sample[0] for sample in samples]
+            timestamps += times
+        if codes != [MARKER_CODES[text] for text in names]:
+            raise RuntimeError("The markers received don't match the markers sent")
+        offsets = np.array(timestamps) - reference_times
+    else:
+        # Send latency measured by the RCS backend, from its own stamp (taken right after the flip), of the markers
+        # that were acknowledged
+        names = [text for text, _ in task.eeg_interface.backend.marker_latencies]
+        offsets = np.array([latency for _, latency in task.eeg_interface.backend.marker_latencies])
+    return names, offsets * 1000, task.eeg_interface.marker_report()
+
+def summary(names, offsets):
+    markers = {}
+    for text in dict.fromkeys(names):
+        values = offsets[[i for i, name in enumerate(names) if name == text]]
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        markers[text] = {'n': len(values), 'p50_ms': round(p50, 4), 'p95_ms': round(p95, 4), 'p99_ms': round(p99, 4)}
+    return markers
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=root_dir, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--refresh-rate', type=float, default=60.0)
+    parser.add_argument('--backends', nargs='+', default=['lsl'], choices=['lsl', 'rcs'])
+    parser.add_argument('--fake-rcs', action='store_true', help='Run the rcs backend against a local fake RCS (fake_rcs.py)')
+    parser.add_argument('--rcs-stall', type=float, default=0.0, help='Seconds the fake RCS takes to acknowledge each annotation')
+    parser.add_argument('--rcs-drop', type=float, default=0.0, help='Fraction of the annotations the fake RCS never acknowledges')
+    parser.add_argument('--rcs-timeout', type=float, default=None, help='Seconds to wait for each acknowledgement (RCSMarkerBackend.rcs_timeout)')
+    parser.add_argument('--output', default='marker_latency.json')
+    args = parser.parse_args()
+
+    fake_rcs = None
+    if args.fake_rcs:
+        fake_rcs = FakeRCS(stall=args.rcs_stall, drop=args.rcs_drop, seed=0)
+        RCSMarkerBackend.rcs_host, RCSMarkerBackend.rcs_port = fake_rcs.host, fake_rcs.port
+    if args.rcs_timeout is not None:
+        RCSMarkerBackend.rcs_timeout = args.rcs_timeout
+
+    # Synthetic EEG streamed in the background for the whole benchmark
+    eeg_outlet = BetaGeneratorOutlet(Fs=1000, verbose=False)
+    running = [True]
+    def stream_eeg():
+        while running[0]:
+            eeg_outlet.update()
+    threading.Thread(target=stream_eeg, daemon=True).start()
+
+    results = {'version': git_version(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'trials': args.trials,
+               'refresh_rate': args.refresh_rate, 'backends': {}, 'reports': {}}
+    if fake_rcs is not None:
+        results['fake_rcs'] = {'stall': args.rcs_stall, 'drop': args.rcs_drop}
+    with tempfile.TemporaryDirectory() as results_dir:
+        for backend in args.backends:
+            names, offsets, report = run_trials(backend, args.trials, args.refresh_rate, results_dir)
+            results['backends'][backend] = summary(names, offsets)
+            results['reports'][backend] = report
+            for text, stats in results['backends'][backend].items():
+                print(f"{backend} {text:>24}: p50 {stats['p50_ms']:.3f} ms, p95 {stats['p95_ms']:.3f} ms, p99 {stats['p99_ms']:.3f} ms")
+            print(f"{backend} markers: {report}")
+    running[0] = False
+    if fake_rcs is not None:
+        print(f"Fake RCS: {len(fake_rcs.annotations)} annotations received, {fake_rcs.n_dropped} not acknowledged")
+        fake_rcs.close()
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved to {args.output}")
@@ -0,0 +1,124 @@
+"""
+Timing jitter of the MID trials with the real-time mode (mid.RealtimeMode) off and on.
+
+Runs a simulated session (80 learning, 10 refresh and 80 reverse learning trials, with a synthetic participant) on a
+NullWindow paced at the refresh rate, once per mode. The paced window records how late each flip of the timed phases
+(fixation, SOA and feedback) returns after its frame boundary, the dropped frames of those phases are counted, and a gc
+callback records every garbage collection that runs during a timed phase. To make the collector behave as it does with
+PsychoPy loaded, a heap of live objects is kept (--heap) and every frame leaves cyclic garbage (--garbage).
+
+Each session lasts as long as the real one (about 15 minutes for 170 trials); use --trials for a shorter run.
+
+    python extras/benchmarks/realtime_jitter.py [--trials 170] [--modes off on] [--cpu N] [--output realtime_jitter.json]
+"""
+import os, sys, gc, json, time, argparse, tempfile, subprocess
+import numpy as np
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, root_dir)
+from mid import MonetaryIncentiveDelayTask, QLearningResponder, NullWindow, FrameScheduler, RealtimeMode
+
+TIMED_PHASES = ['fixation', 'soa', 'feedback']
+
+class JitterWindow(NullWindow):
+    # Paced NullWindow that records how late each flip returns after its frame boundary (and whether it was a flip of a
+    # timed phase), and leaves cyclic garbage
+    def __init__(self, refresh_rate, garbage, n_frames=2**18):
+        super().__init__(refresh_rate, paced=True)
+        self.garbage = garbage
+        self.scheduler = None
+        self.lateness = np.zeros(n_frames)
+        self.timed = np.zeros(n_frames, dtype=bool)
+        self.n_flips = 0
+
+    def flip(self, clearBuffer=True):
+        for i in range(self.garbage):
+            cycle = {}
+            cycle['self'] = cycle
+        timed = self.scheduler.phase in TIMED_PHASES
+        t = super().flip(clearBuffer)
+        self.lateness[self.n_flips % len(self.lateness)] = self.clock() - t
+        self.timed[self.n_flips % len(self.lateness)] = timed
+        self.n_flips += 1
+        return t
+
+def run_session(realtime, n_trials, refresh_rate, garbage, cpu, results_dir):
+    task = MonetaryIncentiveDelayTask(f"bench_{'on' if realtime else 'off'}", 'A', 1, QLearningResponder(seed=0), results_dir, seed_value=1)
+    task.win = JitterWindow(refresh_rate, garbage)
+    task.scheduler = task.win.scheduler = FrameScheduler(task.win)
+    task.realtime_mode = RealtimeMode(realtime, cpu)
+    task.make_session_plan(['learn', 'refresh', 'reverse'])
+
+    # Garbage collections (start, duration) and whether they ran in a timed phase
+    collections = []
+    started = [None]
+    def on_gc(phase, info):
+        if phase == 'start':
+            started[0] = time.perf_counter()
+        else:
+            collections.append((time.perf_counter() - started[0], task.scheduler.phase in TIMED_PHASES))
+    gc.callbacks.append(on_gc)
+    n_learn = min(n_trials, task.n_trials)
+    n_refresh = min(n_trials - n_learn, len(task.refresh_trials))
+    n_reverse = min(n_trials - n_learn - n_refresh, task.n_trials)
+    try:
+        status = task.realtime_mode.start()
+        for cond, n in [('learn', n_learn), ('refresh', n_refresh), ('reverse', n_reverse)]:
+            for i in range(n):
+                task.run_trial(cond, i + 1)
+    finally:
+        task.realtime_mode.stop()
+        gc.callbacks.remove(on_gc)
+    task.save_results()
+
+    n_flips = min(task.win.n_flips, len(task.win.lateness))
+    lateness = task.win.lateness[:n_flips][task.win.timed[:n_flips]] * 1000
+    # Achieved duration (ms) of each timed phase minus its whole number of frames, which only dropped frames change
+    trials = task.trial_data.array()
+    timing = np.stack([trials[f"{phase}{suffix}"] for phase in TIMED_PHASES for suffix in ['_req_ms', '_ms']], axis=1).astype(float)
+    frame_ms = task.scheduler.frame_dur * 1000
+    errors = timing[:, 1::2] - np.maximum(1, np.round(timing[:, 0::2] / frame_ms)) * frame_ms
+    in_phase = [duration * 1000 for duration, timed in collections if timed]
+    p50, p99 = np.percentile(lateness, [50, 99])
+    return {'status': status, 'trials': len(task.trial_data), 'timed_flips': len(lateness),
+            'dropped_frames': int(trials['dropped_frames'].sum()),
+            'flip_lateness_ms': {'p50': round(p50, 4), 'p99': round(p99, 4), 'max': round(float(lateness.max()), 4)},
+            'phase_error_ms': {phase: {'sd': round(float(errors[:, i].std()), 4), 'max': round(float(errors[:, i].max()), 4)}
+                               for i, phase in enumerate(TIMED_PHASES)},
+            'gc_in_timed_phases': {'n': len(in_phase), 'max_ms': round(max(in_phase, default=0.0), 4)},
+            'gc_total': len(collections), 'iti_collect_max_ms': round(max(task.realtime_mode.collect_durations, default=0.0) * 1000, 4)}
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=root_dir, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=170)
+    parser.add_argument('--refresh-rate', type=float, default=60.0)
+    parser.add_argument('--modes', nargs='+', default=['off', 'on'], choices=['off', 'on'])
+    parser.add_argument('--cpu', type=int, default=None, help='CPU to pin the task to in real-time mode')
+    parser.add_argument('--heap', type=int, default=500000, help='Live objects kept during the sessions')
+    parser.add_argument('--garbage', type=int, default=200, help='Cyclic objects left as garbage every frame')
+    parser.add_argument('--output', default='realtime_jitter.json')
+    args = parser.parse_args()
+
+    heap = [[i] for i in range(args.heap)]
+    results = {'version': git_version(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'trials': args.trials,
+               'refresh_rate': args.refresh_rate, 'heap': args.heap, 'garbage': args.garbage, 'modes': {}}
+    with tempfile.TemporaryDirectory() as results_dir:
+        for mode in args.modes:
+            stats = run_session(mode == 'on', args.trials, args.refresh_rate, args.garbage, args.cpu, results_dir)
+            results['modes'][mode] = stats
+            lateness = stats['flip_lateness_ms']
+            gc_stats = stats['gc_in_timed_phases']
+            print(f"realtime {mode:>3} ({stats['status'] or 'normal'}): {stats['trials']} trials, {stats['dropped_frames']} dropped frames, "
+                  f"flip lateness p50 {lateness['p50']:.3f} ms, p99 {lateness['p99']:.3f} ms, max {lateness['max']:.3f} ms, "
+                  f"{gc_stats['n']} collections in timed phases (max {gc_stats['max_ms']:.3f} ms), "
+                  f"ITI collections max {stats['iti_collect_max_ms']:.3f} ms")
+            for phase, error in stats['phase_error_ms'].items():
+                print(f"    {phase:>8} duration error: sd {error['sd']:.3f} ms, max {error['max']:.3f} ms")
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved to {args.output}")
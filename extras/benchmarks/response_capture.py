@@ -0,0 +1,46 @@
+"""
+Latency of the response capture (mid.ResponseCapture) with synthetic key events.
+
+For each trial a key press is injected from another thread at a random delay after start(), like the keyboard driver
+would deliver it. We measure how long wait() takes to return after the press (capture latency) and how far the
+returned reaction time is from the true one (RT error), with the capture thread and with polling from wait().
+
+    python extras/benchmarks/response_capture.py [n_trials]
+"""
+import os, sys, time, random, threading
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from mid import ResponseCapture, SyntheticKeyboard
+
+def run(n_trials, threaded):
+    kb = SyntheticKeyboard()
+    capture = ResponseCapture(kb, threaded=threaded)
+    capture_latency = np.zeros(n_trials)
+    rt_error = np.zeros(n_trials)
+    for i in range(n_trials):
+        press = {}
+        def inject(delay):
+            time.sleep(delay)
+            press['t'] = kb.now()
+            kb.press('left')
+        capture.start()
+        injector = threading.Thread(target=inject, args=(random.uniform(0.005, 0.02),))
+        injector.start()
+        key, rt = capture.wait(['left', 'down', 'right'])
+        returned = kb.now()
+        injector.join()
+        capture_latency[i] = returned - press['t']
+        rt_error[i] = rt - (press['t'] - capture.onset)
+    return capture_latency * 1000, rt_error * 1000
+
+def summary(values):
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return f"p50 {p50:.3f} ms, p95 {p95:.3f} ms, p99 {p99:.3f} ms, max {values.max():.3f} ms"
+
+if __name__ == '__main__':
+    n_trials = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    for threaded in [True, False]:
+        capture_latency, rt_error = run(n_trials, threaded)
+        print(f"{'Capture thread' if threaded else 'Polling in wait()'} ({n_trials} presses)")
+        print(f"  capture latency: {summary(capture_latency)}")
+        print(f"  RT error:        {summary(np.abs(rt_error))}")
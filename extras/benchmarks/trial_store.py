@@ -0,0 +1,66 @@
+"""
+Cost of storing the trials of a part: mid.TrialStore against the previous list of lists.
+
+For the trials of a part 1 (2 test and 170 learning trials with random outcomes) both versions add every trial with its
+accumulated result and streak, format its row of the results file (the writer thread does this) and, at the end of
+the part, produce the typed array saved as the .npy. The list version is the code the task used before TrialStore.
+
+    python extras/benchmarks/trial_store.py [n_parts]
+"""
+import os, sys, time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from mid import TrialStore, RESULTS_ROW_FORMAT, results_to_array
+
+TIMING = [1500.0, 1500.0, 2522.9, 2516.7, 1000.0, 1000.0]
+
+def make_trials(n_trials, seed=0):
+    rng = np.random.default_rng(seed)
+    rewards = rng.integers(0, 2, (n_trials, 3)).tolist()
+    chests = rng.integers(0, 3, n_trials).tolist()
+    return [('learn', i + 1, rewards[i], int(rng.integers(300, 900)), chests[i], int(rng.integers(200, 600)), '2', rewards[i][chests[i]])
+            for i in range(n_trials)]
+
+def list_part(trials):
+    # Previous version: rows as lists, the total and streak read from the last row, rows joined as text
+    trial_data = []
+    add = format_row = 0.0
+    for cond, trial_n, reward, chest_latency, chest, confidence_latency, confidence, hit in trials:
+        start = time.perf_counter()
+        n = int(trial_data[-1][8]) if len(trial_data) > 0 else 0
+        result = n + 10 if hit == 1 else n - 10
+        streak = trial_data[-1][9] + 1 if len(trial_data) > 0 and bool(hit) else hit
+        trial_data.append([cond, trial_n, reward, chest_latency, chest, confidence_latency, confidence, hit, result, streak, 0] + TIMING + [0])
+        middle = time.perf_counter()
+        line = ';'.join(str(value) for value in trial_data[-1]) + '\n'
+        end = time.perf_counter()
+        add += middle - start
+        format_row += end - middle
+    start = time.perf_counter()
+    results = results_to_array(trial_data, 'bench', 'A', 1)
+    return add, format_row, time.perf_counter() - start
+
+def store_part(trials):
+    trial_data = TrialStore(len(trials), 'bench', 'A', 1)
+    add = format_row = 0.0
+    for cond, trial_n, reward, chest_latency, chest, confidence_latency, confidence, hit in trials:
+        start = time.perf_counter()
+        row = trial_data.add(cond, trial_n, reward, chest_latency, chest, confidence_latency, int(confidence), hit, 0, TIMING, 0)
+        middle = time.perf_counter()
+        line = RESULTS_ROW_FORMAT % row
+        end = time.perf_counter()
+        add += middle - start
+        format_row += end - middle
+    start = time.perf_counter()
+    results = trial_data.array()
+    return add, format_row, time.perf_counter() - start
+
+if __name__ == '__main__':
+    n_parts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    trials = make_trials(172)
+    for name, run_part in [('list of lists', list_part), ('TrialStore', store_part)]:
+        run_part(trials) # Warm up
+        times = np.array([run_part(trials) for i in range(n_parts)]) * 1e6
+        add, format_row, array = np.median(times, axis=0)
+        print(f"{name:>13}: add {add / len(trials):.2f} us/trial, row text {format_row / len(trials):.2f} us/trial, "
+              f".npy array {array:.1f} us/part, total {(add + format_row + array) / len(trials):.2f} us/trial")
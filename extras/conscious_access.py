@@ -2,14 +2,25 @@
 # importing relevant modules
 from psychopy import visual, event, core, gui, data, monitors
 import random
+import numpy as np
 import pandas as pd
 import os
 import os.path as op
+import sys
+import queue
+import threading
 from pylsl import StreamInfo, StreamOutlet
 from time import sleep
 import time
 from random import randint
 
+# Excel copy of the results, written after the session (the .csv and .npy are written during it).
+# An existing .csv can also be exported on its own: python conscious_access.py --export-xlsx <results.csv>
+export_xlsx = True
+if len(sys.argv) > 2 and sys.argv[1] == '--export-xlsx':
+    pd.read_csv(sys.argv[2], sep=';', index_col=0).to_excel(op.splitext(sys.argv[2])[0] + '.xlsx')
+    sys.exit()
+
 info = StreamInfo(name='backwardmasking', type='Markers', channel_count=1, channel_format='int32', source_id='backwardmasking_001')
 
 outlet = StreamOutlet(info)  # Broadcast the stream.
@@ -110,6 +121,11 @@ t8 = visual.TextStim(win=win, text='8',units='norm', height=0.15, color='black')
 
 t3 = visual.TextStim(win=win, text='3',units='norm', height=0.15, color='black')
 
+blank = visual.TextStim(win=win, text=' ',units='norm', height=0.15, color='gainsboro')
+
+# Target stimulus of each image name in the trial list
+target_stims = {'2.tif': t2, '3.tif': t3, '7.tif': t7, '8.tif': t8, 'blank.tiff': blank}
+
 #TERGET KOY BURAYA
 mask_image = visual.SimpleImageStim(win=win,
                                     image=op.join(images_dir, 'mask3_grey.tif'))
@@ -143,35 +159,104 @@ scale_rating2 = visual.RatingScale(win=win,
                                    acceptKeys=['space', 'num_enter'])
 
 # Trials
-trial_list_df = pd.read_excel(op.join(trial_dir, "trial_list_final.xlsx"))
-trial_list_df = trial_list_df.fillna(0)
-trial_list_df = trial_list_df.replace(to_replace=0, value='')
+def load_trial_list(xlsx_file):
+    # The trial list as a typed record array (text columns as str, empty cells '' or 0). Reading the Excel file is slow,
+    # so the array is cached in a .npy next to it and read from there until the Excel file changes.
+    cache_file = op.splitext(xlsx_file)[0] + '.npy'
+    if op.exists(cache_file) and op.getmtime(cache_file) >= op.getmtime(xlsx_file):
+        return np.load(cache_file, allow_pickle=False)
+    df = pd.read_excel(xlsx_file)
+    columns = []
+    for name in df.columns:
+        if pd.api.types.is_numeric_dtype(df[name]):
+            values = df[name].fillna(0).to_numpy()
+            if np.all(values == np.round(values)):
+                values = values.astype(int)
+        else:
+            values = df[name].fillna('').astype(str).to_numpy().astype(str)
+        columns.append(values)
+    trial_list = np.rec.fromarrays(columns, names=[str(name) for name in df.columns])
+    np.save(cache_file, trial_list, allow_pickle=False)
+    return trial_list
+
+trial_list = load_trial_list(op.join(trial_dir, "trial_list_final.xlsx"))
+
+# Everything the trial loop reads, per trial (row of the trial list): Python lists, so reading them allocates nothing
+trial_soa = trial_list['SOA'].astype(int).tolist()
+trial_position = [(position, 0.0) for position in trial_list['position'].tolist()]
+trial_target = trial_list['target'].tolist()
+trial_mask = trial_list['mask'].tolist()
+trial_answer = trial_list['cor_ans'].tolist()
+trial_trigger = trial_list['trigger'].tolist()
 
 #order of trials
-order = []
-for i in range(len(trial_list_df)):  # len(trial_list_df)):
-    order.append(i)
+order = list(range(len(trial_list)))
 
 # data storage
-col_participant = []
-col_stim = []
-col_session = []
-col_block = []
-col_order = []
-col_frame_rate = []
-col_frame_int = []
-col_real_soa = []
-col_positions = []
-col_targets = []
-col_masks = []
-col_soas = []
-col_answers = []
-col_obj_rating = []
-col_obj_RT = []
-col_subj_rating = []
-col_subj_RT = []
-col_trial_dur = []
-col_trigger = []
+# One row per trial, preallocated for the whole session. frame_int holds the frame intervals of the target and the SOA
+# (padded with NaN). Each completed block is written to disk by a background thread (see write_blocks).
+n_block = 4
+results = np.zeros(n_block * len(trial_list), dtype=[
+    ('subject', 'U64'), ('stim', 'U1'), ('session', 'U4'), ('block', 'i4'), ('frame_rate', 'f8'),
+    ('frame_int', 'f8', (target_dur + max(trial_soa),)), ('trial_nb', 'i4'), ('SOA', 'i4'), ('real_SOA', 'f8'),
+    ('target', trial_list['target'].dtype), ('mask', trial_list['mask'].dtype), ('position', 'f8'),
+    ('cor_ans', trial_list['cor_ans'].dtype), ('obj_rating', 'U8'), ('obj_RT', 'f8'), ('subj_rating', 'i1'),
+    ('subj_RT', 'f8'), ('trial_duration', 'f8'), ('trigger', trial_list['trigger'].dtype)])
+results['frame_int'] = np.nan
+n_results = 0
+
+csv_file = filename + '.csv'
+csv_rows = 0 # Trials already in csv_file
+
+def block_frame(block):
+    # DataFrame of a slice of results, with the NaN padding of frame_int removed
+    rows = results[block]
+    columns = {name: rows[name] for name in results.dtype.names}
+    columns['frame_int'] = [intervals[~np.isnan(intervals)].tolist() for intervals in rows['frame_int']]
+    return pd.DataFrame(columns, index=range(block.start, block.stop))
+
+def write_csv(block):
+    # Append the trials not yet in the .csv (the block, plus any earlier one whose write failed). If the .csv stays locked
+    # (e.g. it is open in Excel), move to a new .csv with every trial so far
+    global csv_file, csv_rows
+    for attempt in range(3):
+        try:
+            block_frame(slice(csv_rows, block.stop)).to_csv(csv_file, sep=';', mode='a' if csv_rows else 'w',
+                                                            header=not csv_rows)
+            csv_rows = block.stop
+            return
+        except OSError as error:
+            print(f'Could not write {csv_file} ({error}), retrying')
+            sleep(1)
+    csv_file, csv_rows = f'{filename}_{block.stop}.csv', 0
+    print(f'Saving the trials to {csv_file} instead')
+    block_frame(slice(0, block.stop)).to_csv(csv_file, sep=';')
+    csv_rows = block.stop
+
+def write_npy(block):
+    # Save every trial so far to the .npy
+    with open(filename + '.npy.tmp', 'wb') as f:
+        np.save(f, results[:block.stop])
+    os.replace(filename + '.npy.tmp', filename + '.npy')
+
+def save_block(block):
+    # Write a completed block (a slice of results). A failed write is reported and caught up with the next block
+    for write in (write_csv, write_npy):
+        try:
+            write(block)
+        except Exception as error:
+            print(f'Could not save trials {block.start}-{block.stop - 1} ({write.__name__}): {error!r}')
+
+def write_blocks():
+    while True:
+        block = block_queue.get()
+        if block is None:
+            break
+        save_block(block)
+
+block_queue = queue.Queue()
+block_writer = threading.Thread(target=write_blocks, daemon=True)
+block_writer.start()
 sumSOA = 0
 
 # fixation cross & initializing clock
@@ -181,10 +266,10 @@ win.flip()
 core.wait(1)
 
 # iteration over the randomised trial list
-n_block = 4
 n = 0
 for i in range(n_block):
     random.shuffle(order) #random order of the trials
+    block_start = n_results
 
     for trial in order:
         #random order of rating
@@ -194,32 +279,17 @@ for i in range(n_block):
         else:
             scale_rating = scale_rating2
         # setting parameters for this trial
-        soa_dur = int(trial_list_df.loc[trial]['SOA']) #row = trial, column = SOA
+        soa_dur = trial_soa[trial] #row = trial, column = SOA
         dotUR.pos = (0.5, 0.5)
         dotUL.pos = (-0.5, 0.5)
         dotDR.pos = (0.5, -0.5)
         dotDL.pos = (-0.5, -0.5)
-        stim=trial_list_df.loc[trial]['target']
-        if stim=='2.tif':
-            t=t2
-            #t.pos=([trial_list_df.loc[trial]['position'], 0.0])
-        if stim=='3.tif':
-            t=t3
-            #t.pos=([trial_list_df.loc[trial]['position'], 0.0])
-        if stim=='7.tif':
-            t=t7
-            #t.pos=([trial_list_df.loc[trial]['position'], 0.0])
-        if stim=='8.tif':
-            t=t8
-            #t.pos=([trial_list_df.loc[trial]['position'], 0.0])
-        if stim=='blank.tiff':
-            t= visual.TextStim(win=win, text=' ',units='norm', height=0.15, color='gainsboro')
-        t.setPos([trial_list_df.loc[trial]['position'], 0.0]) #position of target
+        t = target_stims[trial_target[trial]]
+        t.setPos(trial_position[trial]) #position of target
         t.contrast=-0.258 #determined with staircase
-        mask_image.setPos(
-            [trial_list_df.loc[trial]['position'], 0.0]) #same position for mask
+        mask_image.setPos(trial_position[trial]) #same position for mask
         # mask_image.setImage(
-        #     op.join(images_dir, trial_list_df.loc[trial]['mask']))
+        #     op.join(images_dir, trial_mask[trial]))
         obj_rating = [] #objective rating (higher/lower 5)
         scale_rating.reset() #subjective rating (seen/not seen)
 #        scale_rating.setMarkerPos(random.randint(0,1))
@@ -258,7 +328,7 @@ for i in range(n_block):
                 win.flip()
                  #send target trigger!
 #                win.callOnFlip(reset_clock_and_send_trigger,
-#                              trial_list_df.loc[trial]['trigger'])
+#                              trial_trigger[trial])
 #                win.callOnFlip(reset_clock_and_send_trigger, 0)
 
             # SOA
@@ -325,27 +395,36 @@ for i in range(n_block):
         for frameN in range(20): #empty screen for 20 frames?
             win.flip()
 
-        # fill the colums during the experiment
-        col_participant.append(exp_info['Participant'])
-        col_stim.append(exp_info['Stim'])
-        col_session.append(exp_info['Session'])
-        col_block.append(i+1)
-        col_frame_rate.append(exp_info['frame_rate'])
-        col_frame_int.append(l)
-        col_real_soa.append(real_soa)
-        col_order.append(trial)
-        col_positions.append(trial_list_df.loc[trial]['position'])
-        col_targets.append(trial_list_df.loc[trial]['target'])
-        col_masks.append(trial_list_df.loc[trial]['mask'])
-        col_soas.append(trial_list_df.loc[trial]['SOA'])
-        col_answers.append(trial_list_df.loc[trial]['cor_ans'])
-        col_obj_rating.append(obj_rating)
-        col_obj_RT.append(obj_RT)
-        col_subj_rating.append(subj_rating)
-        col_subj_RT.append(subj_RT)
-        col_trial_dur.append(trial_dur)
-        col_trigger.append(trial_list_df.loc[trial]['trigger'])
+        # fill the row of the trial during the experiment
+        row = results[n_results]
+        row['subject'] = exp_info['Participant']
+        row['stim'] = exp_info['Stim']
+        row['session'] = exp_info['Session']
+        row['block'] = i+1
+        row['frame_rate'] = np.nan if exp_info['frame_rate'] is None else exp_info['frame_rate']
+        row['frame_int'][:len(l)] = l
+        row['real_SOA'] = real_soa
+        row['trial_nb'] = trial
+        row['position'] = trial_position[trial][0]
+        row['target'] = trial_target[trial]
+        row['mask'] = trial_mask[trial]
+        row['SOA'] = soa_dur
+        row['cor_ans'] = trial_answer[trial]
+        row['obj_rating'] = obj_rating[0]
+        row['obj_RT'] = obj_RT
+        row['subj_rating'] = subj_rating
+        row['subj_RT'] = subj_RT
+        row['trial_duration'] = trial_dur
+        row['trigger'] = trial_trigger[trial]
+        n_results += 1
     
+    # write the block in the background (here if the writer thread stopped)
+    if block_writer.is_alive():
+        block_queue.put(slice(block_start, n_results))
+    else:
+        print('The block writer stopped, saving the block in the main thread')
+        save_block(slice(block_start, n_results))
+
     #change hands --> also change keys?
     if i == 1: #after the second block this message is shown
         textPause = visual.TextStim(
@@ -359,35 +438,20 @@ for i in range(n_block):
         for frameN in range(40):
             win.flip()
 
-# Store the data in a dataframe
-participant_df = pd.DataFrame({
-    'subject': col_participant,
-    'stim': col_stim,
-    'session': col_session,
-    'block': col_block,
-    'frame_rate': col_frame_rate,
-    'frame_int': col_frame_int,
-    'trial_nb': col_order,
-    'SOA': col_soas,
-    'real_SOA': col_real_soa,
-    'target': col_targets,
-    'mask': col_masks,
-    'position': col_positions,
-    'cor_ans': col_answers,
-    'obj_rating': col_obj_rating,
-    'obj_RT': col_obj_RT,
-    'subj_rating': col_subj_rating,
-    'subj_RT': col_subj_RT,
-    'trial_duration': col_trial_dur,
-    'trigger': col_trigger})
+# Wait for the last block to be written
+if block_writer.is_alive():
+    block_queue.put(None)
+    block_writer.join()
 
 print('Overall, %i frames were dropped' % win.nDroppedFrames)
 # plt.plot(win.frameIntervals)
 
-participant_df.to_excel(filename+'.xlsx')
-participant_df.to_csv(filename+'.csv', sep=';')
 win.saveFrameIntervals(filename+'_frame.csv')
 
 # plt.show()
 win.close()
+
+# Excel copy (slow, so it is written once the session is over)
+if export_xlsx:
+    pd.read_csv(csv_file, sep=';', index_col=0).to_excel(filename + '.xlsx')
 core.quit()
@@ -0,0 +1,220 @@
+"""
+Online ERP averages of the MID task, updated while the session runs.
+
+OnlineERP reads the EEG stream and the 'MID_markers' stream (LSL marker backend) through the ring buffers of
+ring_buffer_inlet.py. It cuts an epoch around every result_fixation_shown and feedback_shown marker as soon as the
+EEG after it has arrived, subtracts the baseline and adds the epoch to the running mean and variance (Welford) of
+its condition: learning (and refresh) or reverse learning block, hit or miss (the feedback_hit/feedback_miss marker
+of the trial). Test trials are not averaged.
+
+With the default window (-0.2 to 0.8 s) the feedback epoch is complete before the feedback screen ends, so each
+trial is averaged during its ITI. Running this file tests it in simulation, with the synthetic EEG of
+pylsl_examples/PerformanceTest.py, and reports how long the updates take:
+
+    python extras/online_erp.py [--trials 20] [--interval 0.02]
+"""
+import os, sys, time, argparse, threading, collections
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from ring_buffer_inlet import RingBufferInlet, MarkerRingBuffer
+
+EPOCH_MARKERS = ['result_fixation_shown', 'feedback_shown']
+BLOCKS = ['learn', 'reverse']
+OUTCOMES = ['miss', 'hit']
+OUTCOME_MARKERS = ['feedback_miss', 'feedback_hit'] # In the order of OUTCOMES
+# Block (index in BLOCKS) that starts with each marker, None for the markers after which epochs are not averaged
+BLOCK_MARKERS = {'test_trials_start': None, 'learning_trials_start': 0, 'refresh_learning_trials_start': 0,
+                 'reverse_learning_trials_start': 1, 'learning_trials_end': None, 'refresh_learning_trials_end': None,
+                 'reverse_learning_trials_end': None}
+
+class OnlineERP(object):
+    def __init__(self, eeg_stream, marker_stream, tmin=-0.2, tmax=0.8, baseline=(-0.2, 0.0), buffer_duration=10.0):
+        """
+        :param eeg_stream:      StreamInfo of the EEG stream
+        :param marker_stream:   StreamInfo of the MID marker stream (its description holds the marker codes)
+        :param tmin:            Start of the epoch relative to the marker (s)
+        :param tmax:            End of the epoch relative to the marker (s)
+        :param baseline:        Interval (s, relative to the marker) whose mean is subtracted from each channel
+        :param buffer_duration: Seconds of EEG kept; epochs whose data is older than this are dropped
+        """
+        self.eeg = RingBufferInlet(eeg_stream, duration=buffer_duration)
+        self.markers = MarkerRingBuffer(marker_stream)
+        codes = {label: code for code, label in self.markers.labels.items()}
+        missing = [name for name in EPOCH_MARKERS + OUTCOME_MARKERS + ['trial_start'] + list(BLOCK_MARKERS) if name not in codes]
+        if missing:
+            raise ValueError(f"The marker stream doesn't describe the MID marker codes (missing {', '.join(missing)})")
+        # What each code means: an epoch, the outcome of the trial, a new trial or the block that follows
+        self.actions = {codes[name]: ('epoch', i) for i, name in enumerate(EPOCH_MARKERS)}
+        self.actions.update({codes[name]: ('outcome', i) for i, name in enumerate(OUTCOME_MARKERS)})
+        self.actions[codes['trial_start']] = ('trial', None)
+        self.actions.update({codes[name]: ('block', block) for name, block in BLOCK_MARKERS.items()})
+
+        # Epoch in samples
+        srate = self.eeg.srate
+        self.tmin = tmin
+        self.n_times = int(round((tmax - tmin) * srate))
+        self.times = tmin + np.arange(self.n_times) / srate
+        self.baseline = slice(int(round((baseline[0] - tmin) * srate)), int(round((baseline[1] - tmin) * srate)))
+
+        # Running statistics per marker, block and outcome, and work arrays (nothing is allocated per epoch)
+        shape = (len(EPOCH_MARKERS), len(BLOCKS), len(OUTCOMES))
+        epoch_shape = (self.n_times, self.eeg.channel_count)
+        self.counts = np.zeros(shape, dtype=int)
+        self.means = np.zeros(shape + epoch_shape)
+        self.m2 = np.zeros(shape + epoch_shape)
+        self.epoch = np.zeros(epoch_shape)
+        self.delta = np.zeros(epoch_shape)
+        self.work = np.zeros(epoch_shape)
+        self.baseline_mean = np.zeros(self.eeg.channel_count)
+
+        self.block = None
+        self.trial_epochs = [] # Epoch markers of the current trial, waiting for its outcome
+        self.pending = collections.deque() # (marker, block, outcome, time) waiting for their EEG
+        self.n_dropped = 0 # Epochs whose EEG was no longer in the buffer
+        self.update_durations = [] # Duration of every update that averaged an epoch (s)
+
+    def update(self):
+        # Pull the new EEG and markers and average the epochs that are complete. Returns the number of epochs averaged.
+        start = time.perf_counter()
+        self.eeg.pull()
+        n_new = self.markers.pull()
+        if n_new:
+            codes, timestamps = self.markers.latest(n_new)
+            for code, t in zip(codes, timestamps):
+                self.process_marker(code, t)
+
+        n_averaged = 0
+        while self.pending:
+            averaged = self.average_epoch(*self.pending[0])
+            if averaged is None:
+                break
+            self.pending.popleft()
+            if averaged: # False: the epoch was dropped
+                n_averaged += 1
+        if n_averaged:
+            self.update_durations.append(time.perf_counter() - start)
+        return n_averaged
+
+    def process_marker(self, code, t):
+        action, value = self.actions.get(int(code), (None, None))
+        if action == 'block':
+            self.block = value
+            self.trial_epochs = []
+        elif action == 'trial':
+            self.trial_epochs = [] # Epochs of a trial without outcome (halted) are discarded
+        elif action == 'epoch' and self.block is not None:
+            self.trial_epochs.append((value, t))
+        elif action == 'outcome':
+            for marker, marker_time in self.trial_epochs:
+                self.pending.append((marker, self.block, value, marker_time))
+            self.trial_epochs = []
+
+    def average_epoch(self, marker, block, outcome, t):
+        # Add the epoch around t to its average. Returns None if its EEG hasn't arrived yet.
+        data, timestamps = self.eeg.window()
+        i = np.searchsorted(timestamps, t + self.tmin)
+        if len(timestamps) == 0 or i + self.n_times > len(timestamps):
+            return None
+        if i == 0 and timestamps[0] > t + self.tmin:
+            self.n_dropped += 1
+            return False
+
+        # Baseline correction
+        epoch = self.epoch
+        np.copyto(epoch, data[i:i + self.n_times])
+        np.mean(epoch[self.baseline], axis=0, out=self.baseline_mean)
+        epoch -= self.baseline_mean
+
+        # Welford: mean += (x - mean) / n, m2 += (x - old mean) * (x - new mean)
+        self.counts[marker, block, outcome] += 1
+        n = self.counts[marker, block, outcome]
+        mean = self.means[marker, block, outcome]
+        np.subtract(epoch, mean, out=self.delta)
+        np.multiply(self.delta, 1.0 / n, out=self.work)
+        mean += self.work
+        np.subtract(epoch, mean, out=self.work)
+        self.work *= self.delta
+        self.m2[marker, block, outcome] += self.work
+        return True
+
+    def average(self, marker, block, outcome):
+        # Mean epoch (n_times, n_channels), its standard error and the number of epochs of a condition
+        key = (EPOCH_MARKERS.index(marker), BLOCKS.index(block), OUTCOMES.index(outcome))
+        n = self.counts[key]
+        sem = np.sqrt(self.m2[key] / (n - 1) / n) if n > 1 else np.full_like(self.means[key], np.nan)
+        return self.means[key], sem, n
+
+    def save(self, file):
+        # Averages, variances and counts of every condition
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variances = self.m2 / (self.counts[..., None, None] - 1)
+        np.savez(file, times=self.times, counts=self.counts, means=self.means, variances=variances,
+                 markers=EPOCH_MARKERS, blocks=BLOCKS, outcomes=OUTCOMES)
+
+if __name__ == '__main__':
+    from pylsl import resolve_byprop, local_clock
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=20, help='Trials of each block (learning and reverse learning)')
+    parser.add_argument('--interval', type=float, default=0.02, help='Seconds between updates')
+    parser.add_argument('--output', default=None, help='Save the averages to this .npz file')
+    args = parser.parse_args()
+
+    root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sys.path.insert(0, root_dir)
+    sys.path.insert(0, os.path.join(root_dir, 'extras', 'pylsl_examples'))
+    import tempfile
+    from mid import MonetaryIncentiveDelayTask, QLearningResponder, NullWindow, FrameScheduler
+    from PerformanceTest import BetaGeneratorOutlet
+
+    # Synthetic EEG streamed in the background
+    eeg_outlet = BetaGeneratorOutlet(Fs=1000, verbose=False)
+    running = [True]
+    def stream_eeg():
+        while running[0]:
+            eeg_outlet.update()
+    threading.Thread(target=stream_eeg, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as results_dir:
+        # Simulated task sending its markers through LSL, paced like a real screen
+        task = MonetaryIncentiveDelayTask('erp', 'A', 1, QLearningResponder(seed=0), results_dir, seed_value=1, marker_backend='lsl')
+        task.win = NullWindow(paced=True, clock=local_clock)
+        task.scheduler = FrameScheduler(task.win)
+        task.make_session_plan(['learn', 'reverse'])
+        task.eeg_interface.debug = False
+        task.eeg_interface.eeg_connect('erp', 'A', 1)
+
+        erp = OnlineERP(resolve_byprop('type', 'EEG', timeout=5)[0],
+                        resolve_byprop('name', task.eeg_interface.backend.stream_name, timeout=5)[0])
+        def update_loop():
+            while running[0]:
+                erp.update()
+                time.sleep(args.interval)
+        updater = threading.Thread(target=update_loop, daemon=True)
+        updater.start()
+        time.sleep(0.5)
+
+        send_marker = task.eeg_interface.eeg_send_marker
+        send_marker('learning_trials_start')
+        for i in range(args.trials):
+            task.run_trial('learn', i + 1)
+        send_marker('reverse_learning_trials_start')
+        for i in range(args.trials):
+            task.run_trial('reverse', i + 1)
+        send_marker('reverse_learning_trials_end')
+        time.sleep(1.0)
+        running[0] = False
+        updater.join()
+        task.save_results()
+
+    for marker in EPOCH_MARKERS:
+        for block in BLOCKS:
+            for outcome in OUTCOMES:
+                mean, sem, n = erp.average(marker, block, outcome)
+                print(f"{marker:>22} {block:>7} {outcome:>4}: {n} epochs")
+    durations = np.array(erp.update_durations) * 1000
+    p50, p99 = np.percentile(durations, [50, 99])
+    print(f"Updates that averaged epochs: {len(durations)}, p50 {p50:.3f} ms, p99 {p99:.3f} ms, max {durations.max():.3f} ms (ITI: 500 ms)")
+    print(f"Dropped epochs: {erp.n_dropped}")
+    if args.output:
+        erp.save(args.output)
+        print(f"Saved to {args.output}")
@@ -80,7 +80,7 @@ class PinkNoiseGenerator(object):
 
 class BetaGeneratorOutlet(object):
     def __init__(self, Fs=2**14, FreqBeta=20.0, AmpBeta=100.0, AmpNoise=20.0, NCyclesPerChunk=4,
-                 channels=["RAW1", "SPK1", "RAW2", "SPK2", "RAW3", "SPK3"]):
+                 channels=["RAW1", "SPK1", "RAW2", "SPK2", "RAW3", "SPK3"], verbose=True):
         """
         :param Fs:              Sampling rate
         :param FreqBeta:        Central frequency of beta band
@@ -88,9 +88,11 @@ class BetaGeneratorOutlet(object):
         :param AmpNoise:        Amplitude of pink noise (uV)
         :param NCyclesPerChunk: Minimum number of cycles of beta in a chunk.
         :param channels:        List of channel names
+        :param verbose:         If True, print every chunk pushed.
         """
         # Saved arguments
         self.FreqBeta = FreqBeta
+        self.verbose = verbose
         self.AmpBeta = AmpBeta                                          # Amplitude of Beta (uV)
         self.AmpNoise = AmpNoise                                        # Amplitude of pink noise
         self.channels = channels
@@ -133,8 +135,9 @@ class BetaGeneratorOutlet(object):
         time_to_sleep = max(0, this_tvec[-1] - local_clock())
         time.sleep(time_to_sleep)
 
-        print("Beta outlet pushing signal with shape {},{} and Beta amp {}".format(this_sig.shape[0], this_sig.shape[1],
-                                                                                   beta_amp))
+        if self.verbose:
+            print("Beta outlet pushing signal with shape {},{} and Beta amp {}".format(this_sig.shape[0], this_sig.shape[1],
+                                                                                       beta_amp))
         self.eeg_outlet.push_chunk(this_sig, timestamp=this_tvec[-1])
 
         self.last_time = local_clock()
@@ -288,17 +291,6 @@ class MarkerInlet(object):
             print("Marker inlet updated with task {}".format(self.task))
 
 
-betaGen = BetaGeneratorOutlet()
-markerGen = MarkersGeneratorOutlet()
-betaIn = BetaInlet()
-markerIn = MarkerInlet()
-
-if haspyqtgraph:
-    qapp = pg.QtGui.QApplication(sys.argv)
-    qwindow = pg.plot()
-    qwindow.clear()
-    qwindow.parent().setWindowTitle("pylsl PerformanceTest")
-
 def update():
     markerGen.update()
     markerIn.update()
@@ -322,6 +314,18 @@ if __name__ == '__main__':
     python3 -m cProfile -o pylsl.cprof PerformanceTest.py
     gprof2dot -f pstats pylsl.cprof | dot -Tpng -o pylsl_prof.png
     """
+    # The outlets and inlets are created here, so the classes above can be imported (e.g. by extras/benchmarks)
+    betaGen = BetaGeneratorOutlet()
+    markerGen = MarkersGeneratorOutlet()
+    betaIn = BetaInlet()
+    markerIn = MarkerInlet()
+
+    if haspyqtgraph:
+        qapp = pg.QtGui.QApplication(sys.argv)
+        qwindow = pg.plot()
+        qwindow.clear()
+        qwindow.parent().setWindowTitle("pylsl PerformanceTest")
+
     try:
         if haspyqtgraph:
             timer = pg.QtCore.QTimer()
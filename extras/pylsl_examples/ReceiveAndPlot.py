@@ -1,59 +1,99 @@
+import os
+import sys
+import collections
 import numpy as np
-from pylsl import StreamInlet, resolve_stream, local_clock
+from pylsl import StreamInlet, resolve_stream, proc_clocksync, cf_int32
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ring_buffer_inlet import RingBufferInlet, MarkerRingBuffer
 
 
 plot_duration = 2.0
+n_marker_lines = 32  # Most markers shown at once
+
+
+class StringMarkers(object):
+    # Last markers of a string marker stream (e.g. SendStringMarkers.py), read with a plain inlet, with the part of the
+    # MarkerRingBuffer interface used by this example
+    def __init__(self, stream, capacity):
+        self.inlet = StreamInlet(stream, processing_flags=proc_clocksync)
+        self.markers = collections.deque(maxlen=capacity)
+
+    def pull(self):
+        strings, timestamps = self.inlet.pull_chunk(timeout=0.0)
+        self.markers.extend(zip([string[0] for string in strings], timestamps))
+        return len(timestamps)
+
+    def since(self, t0):
+        markers = [marker for marker in self.markers if marker[1] >= t0]
+        return [text for text, _ in markers], [t for _, t in markers]
+
+    def label(self, text):
+        return text
 
 
 # first resolve an EEG stream on the lab network
 print("looking for an EEG stream...")
 streams = resolve_stream('type', 'EEG')
 
-# create a new inlet to read from the stream
-inlet = StreamInlet(streams[0])
-markers = StreamInlet(resolve_stream('type', 'Markers')[0])
+# Preallocated buffers: the plot reads views of the last plot_duration seconds, nothing grows while it runs
+inlet = RingBufferInlet(streams[0], duration=plot_duration)
+# int32 markers (like those of the MID task) go to a ring buffer, any other marker stream is read with a plain inlet
+marker_stream = resolve_stream('type', 'Markers')[0]
+if marker_stream.channel_format() == cf_int32:
+    markers = MarkerRingBuffer(marker_stream, capacity=n_marker_lines)
+else:
+    markers = StringMarkers(marker_stream, n_marker_lines)
 
 # Create the pyqtgraph window
 win = pg.GraphicsWindow()
-win.setWindowTitle('LSL Plot ' + inlet.info().name())
+win.setWindowTitle('LSL Plot ' + inlet.inlet.info().name())
 plt = win.addPlot()
 plt.setLimits(xMin=0.0, xMax=plot_duration, yMin=-1.0 * (inlet.channel_count - 1), yMax=1.0)
 
-t0 = [local_clock()] * inlet.channel_count
 curves = []
 for ch_ix in range(inlet.channel_count):
     curves += [plt.plot()]
+# x and y of the curves, reused on every update
+x = np.zeros(inlet.capacity)
+y = np.zeros((inlet.channel_count, inlet.capacity), dtype=np.float32)
+
+# A fixed pool of marker lines, moved to the markers in the window and hidden otherwise
+marker_lines = []
+for i in range(n_marker_lines):
+    line = pg.InfiniteLine(0, angle=90, movable=False, label='')
+    line.hide()
+    plt.addItem(line)
+    marker_lines += [line]
+marker_codes = [None] * n_marker_lines
 
 
 def update():
-    global inlet, curves, t0
-    # Read data from the inlet. Use a timeout of 0.0 so we don't block GUI interaction.
-    chunk, timestamps = inlet.pull_chunk(timeout=0.0, max_samples=32)
-    if timestamps:
-        timestamps = np.asarray(timestamps)
-        y = np.asarray(chunk)
-
-        for ch_ix in range(inlet.channel_count):
-            old_x, old_y = curves[ch_ix].getData()
-            if old_x is not None:
-                old_x += t0[ch_ix]  # Undo t0 subtraction
-                this_x = np.hstack((old_x, timestamps))
-                this_y = np.hstack((old_y, y[:, ch_ix] - ch_ix))
-            else:
-                this_x = timestamps
-                this_y = y[:, ch_ix] - ch_ix
-            t0[ch_ix] = this_x[-1] - plot_duration
-            this_x -= t0[ch_ix]
-            b_keep = this_x >= 0
-            curves[ch_ix].setData(this_x[b_keep], this_y[b_keep])
-    strings, timestamps = markers.pull_chunk(0)
-    if timestamps:
-        print(strings, timestamps)
-        for string, ts in zip(strings, timestamps):
-            plt.addItem(pg.InfiniteLine(ts-t0[0], angle=90, movable=False, label=string[0]))
+    # Read data from the inlet without blocking GUI interaction
+    n_new = inlet.pull() + markers.pull()
+    if not n_new:
+        return
+    data, timestamps = inlet.window(plot_duration)
+    n = len(timestamps)
+    if n == 0:
+        return
+    t0 = timestamps[-1] - plot_duration
+    np.subtract(timestamps, t0, out=x[:n])
+    for ch_ix in range(inlet.channel_count):
+        np.subtract(data[:, ch_ix], ch_ix, out=y[ch_ix, :n])
+        curves[ch_ix].setData(x[:n], y[ch_ix, :n])
 
+    codes, marker_times = markers.since(t0)
+    for i, line in enumerate(marker_lines):
+        if i < len(codes):
+            line.setValue(marker_times[i] - t0)
+            if codes[i] != marker_codes[i]:
+                marker_codes[i] = codes[i]
+                line.label.setFormat(markers.label(codes[i]))
+            line.show()
+        else:
+            line.hide()
 
 
 timer = QtCore.QTimer()
@@ -63,6 +103,5 @@ timer.start(50)
 
 # Start Qt event loop unless running in interactive mode or using pyside.
 if __name__ == '__main__':
-    import sys
     if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
         QtGui.QApplication.instance().exec_()
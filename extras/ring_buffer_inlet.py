@@ -0,0 +1,122 @@
+"""
+Preallocated circular buffers for LSL streams, to monitor EEG during the task without memory churn.
+
+RingBufferInlet keeps the last `duration` seconds of every channel of a numeric stream, in the NumPy type of its channel
+format. Each chunk is pulled straight into the buffer with pull_chunk(dest_obj=...), and every sample is also written
+one buffer length further on (a mirrored buffer), so the most recent N samples are always one contiguous slice: 
+window() returns views, never copies.
+MarkerRingBuffer does the same for an int32 marker stream, like the one the MID task sends with the LSL backend.
+Memory is allocated once, so it stays flat however long the recording is.
+"""
+import numpy as np
+from pylsl import StreamInlet, proc_clocksync, proc_dejitter, cf_float32, cf_double64, cf_int8, cf_int16, cf_int32, cf_int64
+
+# NumPy type of each numeric channel format (pull_chunk writes the samples into dest_obj in the stream's own format)
+CHANNEL_DTYPES = {cf_float32: np.float32, cf_double64: np.float64, cf_int8: np.int8, cf_int16: np.int16,
+                  cf_int32: np.int32, cf_int64: np.int64}
+
+class RingBufferInlet(object):
+    def __init__(self, stream, duration=10.0, max_chunk=1024, processing_flags=proc_clocksync | proc_dejitter):
+        """
+        :param stream:           StreamInfo of the stream (e.g. from resolve_byprop)
+        :param duration:         Seconds of data to keep
+        :param max_chunk:        Maximum number of samples pulled at once
+        :param processing_flags: Inlet post-processing (clock synchronisation and dejitter by default)
+        """
+        self.inlet = StreamInlet(stream, max_chunklen=max_chunk, processing_flags=processing_flags)
+        info = self.inlet.info()
+        self.srate = info.nominal_srate()
+        self.channel_count = info.channel_count()
+        if info.channel_format() not in CHANNEL_DTYPES:
+            raise ValueError(f"Stream '{info.name()}' has a non-numeric channel format ({info.channel_format()})")
+        self.capacity = int(np.ceil(duration * self.srate))
+        self.max_chunk = min(max_chunk, self.capacity)
+        # Two copies of the buffer, one after the other (see window())
+        self.data = np.zeros((2 * self.capacity, self.channel_count), dtype=CHANNEL_DTYPES[info.channel_format()])
+        self.timestamps = np.zeros(2 * self.capacity)
+        self.position = 0 # Where the next sample goes
+        self.n_samples = 0 # Samples received so far
+
+    def pull(self):
+        # Pull everything available into the buffer, returns the number of new samples
+        n_new = 0
+        while True:
+            # Pull directly into the first copy, without crossing its end
+            n = min(self.max_chunk, self.capacity - self.position)
+            end = self.position + n
+            _, timestamps = self.inlet.pull_chunk(timeout=0.0, max_samples=n, dest_obj=self.data[self.position:end])
+            n = len(timestamps)
+            if n == 0:
+                return n_new
+            end = self.position + n
+            self.timestamps[self.position:end] = timestamps
+            # Mirror into the second copy
+            self.data[self.position + self.capacity:end + self.capacity] = self.data[self.position:end]
+            self.timestamps[self.position + self.capacity:end + self.capacity] = self.timestamps[self.position:end]
+            self.position = end % self.capacity
+            self.n_samples += n
+            n_new += n
+
+    def window(self, seconds=None):
+        # Views (no copy) of the last `seconds` of data (n_samples, n_channels) and their timestamps, oldest first.
+        # They are only valid until the next pull().
+        n = min(self.capacity, self.n_samples)
+        if seconds is not None:
+            n = min(n, int(round(seconds * self.srate)))
+        end = self.position + self.capacity
+        return self.data[end - n:end], self.timestamps[end - n:end]
+
+
+class MarkerRingBuffer(object):
+    def __init__(self, stream, capacity=256):
+        """
+        :param stream:   StreamInfo of an int32 marker stream
+        :param capacity: Number of markers to keep
+        """
+        self.inlet = StreamInlet(stream, processing_flags=proc_clocksync)
+        if self.inlet.info().channel_format() != cf_int32:
+            raise ValueError(f"Marker stream '{self.inlet.info().name()}' is not int32")
+        self.capacity = capacity
+        self.codes = np.zeros((2 * capacity, 1), dtype=np.int32)
+        self.timestamps = np.zeros(2 * capacity)
+        self.position = 0
+        self.n_markers = 0
+        # Names of the codes, if the stream describes them (the MID task does)
+        self.labels = {}
+        marker_xml = self.inlet.info().desc().child("markers").child("marker")
+        while marker_xml.name() == "marker":
+            self.labels[int(marker_xml.child_value("code"))] = marker_xml.child_value("label")
+            marker_xml = marker_xml.next_sibling("marker")
+
+    def pull(self):
+        n_new = 0
+        while True:
+            n = self.capacity - self.position
+            _, timestamps = self.inlet.pull_chunk(timeout=0.0, max_samples=n, dest_obj=self.codes[self.position:])
+            n = len(timestamps)
+            if n == 0:
+                return n_new
+            end = self.position + n
+            self.timestamps[self.position:end] = timestamps
+            self.codes[self.position + self.capacity:end + self.capacity] = self.codes[self.position:end]
+            self.timestamps[self.position + self.capacity:end + self.capacity] = self.timestamps[self.position:end]
+            self.position = end % self.capacity
+            self.n_markers += n
+            n_new += n
+
+    def since(self, t0):
+        # Views of the codes and timestamps of the markers after t0, oldest first
+        n = min(self.capacity, self.n_markers)
+        end = self.position + self.capacity
+        timestamps = self.timestamps[end - n:end]
+        start = end - n + np.searchsorted(timestamps, t0)
+        return self.codes[start:end, 0], self.timestamps[start:end]
+
+    def latest(self, n):
+        # Views of the codes and timestamps of the last n markers (e.g. the ones returned by pull()), oldest first
+        n = min(n, self.capacity, self.n_markers)
+        end = self.position + self.capacity
+        return self.codes[end - n:end, 0], self.timestamps[end - n:end]
+
+    def label(self, code):
+        return self.labels.get(int(code), str(code))
@@ -1,58 +1,1281 @@
 # Necessary imports
-import os, random, time
+import os, sys, re, gc, ast, json, time, hashlib, zipfile, tempfile, itertools, threading, collections, concurrent.futures
 import numpy as np
-from psychopy import visual, core, event, gui
-from psychopy.hardware import brainproducts
-from PIL import Image
+
+# PsychoPy takes seconds to import, so it is only imported when needed (load_modules): the start dialog shows first, and
+# the schedule, conversion and results tools don't need it. PIL and the BrainProducts interface are imported where used.
+visual = core = event = keyboard = None
+modules_lock = threading.Lock()
+
+def load_modules():
+    # Import the PsychoPy modules used by the task (once, several threads may call this at the same time)
+    global visual, core, event, keyboard
+    with modules_lock:
+        if visual is None:
+            import psychopy.visual, psychopy.core, psychopy.event, psychopy.hardware.keyboard
+            core, event, keyboard = psychopy.core, psychopy.event, psychopy.hardware.keyboard
+            visual = psychopy.visual
+
+class StartupTimer:
+    """
+    Start and end (seconds from the start of the process) of each startup phase. Phases can run in background threads 
+    (submit), so the report shows which ones overlapped. The threads are only started by the first submit, so importing
+    this module (analysis, simulations, the cohort process pool) starts none.
+    """
+    t0 = time.perf_counter()
+    
+    def __init__(self):
+        self.phases = []
+        self.executor = None
+        
+    def time(self, name, function, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.phases.append((name, start - self.t0, time.perf_counter() - self.t0))
+            
+    def submit(self, name, function, *args, **kwargs):
+        # Run the phase in a background thread. Its result (or its exception) comes from future.result().
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        return self.executor.submit(self.time, name, function, *args, **kwargs)
+    
+    def report(self):
+        lines = [f"{name:>16}: {start:7.3f} s -> {end:7.3f} s ({end - start:.3f} s)" for name, start, end in sorted(self.phases, key=lambda phase: phase[1])]
+        return '\n'.join(['Startup:'] + lines)
+
+startup_timer = StartupTimer()
+
+class RealtimeMode:
+    """
+    Keeps the garbage collector and the other processes out of the timed phases of the trials. While active, automatic
+    garbage collection is off (the objects that exist when it starts are frozen, so they are never scanned again) and
+    collect() is called in the ITI of every trial; the process priority is raised (real-time scheduling on Linux,
+    core.rush elsewhere or when that isn't allowed) and the main thread can be pinned to one CPU. Scheduling and
+    affinity apply to the thread that calls start() (threads started before, like the marker sender, keep theirs).
+    The collection runs after the first frame of the ITI, and the ITI skips the frames it takes (see 
+    FrameScheduler.hold), so the ITI keeps its duration unless the collection takes longer than the ITI (500 ms).
+
+        enabled (bool): Apply the mode (a disabled mode does nothing).
+        cpu (int): CPU to pin the main thread to (e.g. one isolated with isolcpus), None to leave the affinity.
+        priority (int): Real-time (SCHED_FIFO) priority on Linux.
+    """
+
+    def __init__(self, enabled=False, cpu=None, priority=10):
+        self.enabled = enabled
+        self.cpu = cpu
+        self.priority = priority
+        self.active = False
+        self.status = {}
+        self.collect_durations = [] # Seconds taken by each collect()
+
+    def start(self):
+        if not self.enabled or self.active:
+            return self.status
+        self.active = True
+        self.status = {}
+        self.gc_was_enabled = gc.isenabled()
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+        self.status['gc'] = 'off'
+
+        self.previous_scheduler = None
+        if hasattr(os, 'sched_setscheduler'):
+            try:
+                previous = (os.sched_getscheduler(0), os.sched_getparam(0))
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+                self.previous_scheduler = previous
+                self.status['priority'] = f"SCHED_FIFO {self.priority}"
+            except OSError as e:
+                self.status['priority'] = f"SCHED_FIFO not allowed ({e.strerror})"
+        self.rushed = False
+        if self.previous_scheduler is None:
+            load_modules()
+            self.rushed = core.rush(True)
+            self.status['priority'] = 'core.rush' if self.rushed else self.status.get('priority', 'normal')
+
+        self.previous_affinity = None
+        if self.cpu is not None:
+            try:
+                self.previous_affinity = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, {self.cpu})
+                self.status['cpu'] = self.cpu
+            except (AttributeError, OSError) as e:
+                self.previous_affinity = None
+                self.status['cpu'] = f"not pinned ({e})"
+        return self.status
+
+    def collect(self):
+        # Collect the garbage of the trial (in the ITI), returns the time it took (s)
+        if not self.active:
+            return 0.0
+        start = time.perf_counter()
+        gc.collect()
+        duration = time.perf_counter() - start
+        self.collect_durations.append(duration)
+        return duration
+
+    def stop(self):
+        # Restore the garbage collector, the priority and the affinity
+        if not self.active:
+            return
+        self.active = False
+        if self.previous_affinity is not None:
+            os.sched_setaffinity(0, self.previous_affinity)
+        if self.previous_scheduler is not None:
+            os.sched_setscheduler(0, *self.previous_scheduler)
+        elif self.rushed:
+            core.rush(False)
+        gc.unfreeze()
+        if self.gc_was_enabled:
+            gc.enable()
+
+    def report(self):
+        report = dict(self.status)
+        if self.collect_durations:
+            durations = np.array(self.collect_durations) * 1000
+            report.update(collections=len(durations), collect_mean_ms=round(float(durations.mean()), 3),
+                          collect_max_ms=round(float(durations.max()), 3))
+        return report
+
+class TraceSpan:
+    # Times one span of a Tracer (there is one per name and category, so entering it allocates nothing)
+    __slots__ = ('tracer', 'index', 'start')
+
+    def __init__(self, tracer, index):
+        self.tracer = tracer
+        self.index = index
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.index, self.start, time.perf_counter_ns())
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+class Tracer:
+    """
+    Spans of the hot path of the trials (phases, draws, flips, response waits and markers), timed with perf_counter_ns
+    and stored in a preallocated ring buffer. At the end of a part they are saved as a Chrome trace (chrome://tracing or
+    ui.perfetto.dev) with a summary of the percentiles of each span.
+    A disabled tracer allocates nothing: span() returns a shared no-op context manager and wrap() the function itself.
+
+        enabled (bool): Record the spans.
+        capacity (int): Spans kept (the oldest are overwritten).
+    """
+    null_span = NullSpan()
+
+    def __init__(self, enabled=False, capacity=2**17):
+        self.enabled = enabled
+        self.capacity = capacity
+        self.keys = [] # (name, category) of each span index
+        self.spans = {}
+        self.n_spans = 0
+        if enabled:
+            self.indices = np.zeros(capacity, dtype=np.int32)
+            self.starts = np.zeros(capacity, dtype=np.int64)
+            self.ends = np.zeros(capacity, dtype=np.int64)
+
+    def span(self, name, category='task'):
+        # Context manager that records the time spent in its block
+        if not self.enabled:
+            return self.null_span
+        key = (name, category)
+        if key not in self.spans:
+            self.spans[key] = TraceSpan(self, len(self.keys))
+            self.keys.append(key)
+        return self.spans[key]
+
+    def wrap(self, function, name, category='task'):
+        # The function, recording a span each time it is called
+        if not self.enabled:
+            return function
+        span = self.span(name, category)
+        def traced(*args, **kwargs):
+            with span:
+                return function(*args, **kwargs)
+        return traced
+
+    def record(self, index, start, end):
+        i = self.n_spans % self.capacity
+        self.indices[i] = index
+        self.starts[i] = start
+        self.ends[i] = end
+        self.n_spans += 1
+
+    def recorded(self):
+        # Span indices, starts and ends (ns) in the order they ended (only the most recent ones if the buffer wrapped around)
+        if self.n_spans <= self.capacity:
+            return self.indices[:self.n_spans], self.starts[:self.n_spans], self.ends[:self.n_spans]
+        order = np.roll(np.arange(self.capacity), -(self.n_spans % self.capacity))
+        return self.indices[order], self.starts[order], self.ends[order]
+
+    def summary(self, percentiles=(50, 90, 99)):
+        # Count, mean, percentiles and maximum duration (ms) of each span: [(category, name, n, mean, *percentiles, max)]
+        indices, starts, ends = self.recorded()
+        durations = (ends - starts) / 1e6
+        rows = []
+        for index, (name, category) in enumerate(self.keys):
+            d = durations[indices == index]
+            if len(d):
+                rows.append((category, name, len(d), d.mean(), *np.percentile(d, percentiles), d.max()))
+        return sorted(rows)
+
+    def save(self, trace_file, summary_file=None, percentiles=(50, 90, 99)):
+        # Chrome trace event format: one complete ('X') event per span, times in microseconds
+        indices, starts, ends = self.recorded()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 1, 'args': {'name': 'task'}}]
+        for index, start, end in zip(indices.tolist(), starts.tolist(), ends.tolist()):
+            name, category = self.keys[index]
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': start / 1000, 'dur': (end - start) / 1000, 'pid': 1, 'tid': 1})
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        if summary_file is not None:
+            with open(summary_file, 'w') as f:
+                f.write('category;name;n;mean_ms;' + ''.join(f"p{p}_ms;" for p in percentiles) + 'max_ms\n')
+                for category, name, n, *durations in self.summary(percentiles):
+                    f.write(f"{category};{name};{n};" + ';'.join(f"{d:.3f}" for d in durations) + '\n')
+
+def longest_run(trials):
+    # Length of the longest run of identical values along the last axis (one value per row)
+    n = trials.shape[-1]
+    rows = trials.reshape(-1, n)
+    index = np.arange(1, n)
+    # A run starts wherever the value changes, the run ending at each position started at the last change before it
+    run_start = np.maximum.accumulate(np.where(rows[:, 1:] != rows[:, :-1], index, 0), axis=1)
+    longest = np.max(index - run_start + 1, axis=1, initial=1)
+    return longest.reshape(trials.shape[:-1])
+
+def generate_trials(n_subjects, seed, n_trials=80, refresh_n_trials=10, reward_percentage=[0.8, 0.5, 0.2], max_run_length=None, max_attempts=1000,
+                    learn_order=None, shift=None):
+    """
+    Generate the learning, refresh and reverse learning schedules of n_subjects in one vectorized call.
+    
+        n_subjects (int): Number of schedules to generate.
+        seed (int): Seed for the numpy.random.Generator (it is returned with the schedules so it can be recorded).
+        n_trials (int): Number of learning and reverse learning trials.
+        refresh_n_trials (int): Number of refresh trials (only the best learning chest is rewarded).
+        reward_percentage (list): Reward probability of each chest. n_trials * probability must be a whole number, so 
+            every chest has exactly that ratio of rewarded trials.
+        max_run_length (int): Longest allowed run of identical outcomes for a chest (None for no limit). Offending 
+            chests are drawn again, up to max_attempts times.
+        learn_order (array): (n_subjects, n_chests) index in reward_percentage of the chest at each learning position 
+            (drawn at random when not given, see assign_positions).
+        shift (array): (n_subjects,) cyclic shift, from 1 to n_chests - 1, from the learning to the reverse positions 
+            (drawn at random when not given).
+            
+    Returns a dict with the seed and these arrays:
+        learn_positions, reverse_positions (n_subjects, 3): Reward probability of each chest position. Reverse positions 
+            are a derangement of the learning ones (no chest keeps its probability).
+        learn_trials, reverse_trials (n_subjects, n_trials, 3): Reward (1) or loss (0) of each chest on each trial.
+        refresh_trials (n_subjects, refresh_n_trials, 3): Refresh trials.
+    """
+    rng = np.random.default_rng(seed)
+    reward_percentage = np.asarray(reward_percentage, dtype=float)
+    n_chests = len(reward_percentage)
+    n_rewards = np.round(n_trials * reward_percentage).astype(int)
+    if not np.allclose(n_rewards, n_trials * reward_percentage):
+        raise ValueError(f"{n_trials} trials can't have exact reward ratios of {reward_percentage.tolist()}")
+    
+    # Chest positions: a random order for learning, and a cyclic shift of it (a derangement of the three chests) for reversal
+    if learn_order is None:
+        learn_order = rng.permuted(np.tile(np.arange(n_chests), (n_subjects, 1)), axis=1)
+    if shift is None:
+        shift = rng.integers(1, n_chests, n_subjects)
+    learn_order, shift = np.asarray(learn_order), np.asarray(shift)
+    reverse_order = np.take_along_axis(learn_order, (np.arange(n_chests) + shift[:, None]) % n_chests, axis=1)
+    learn_positions = reward_percentage[learn_order]
+    reverse_positions = reward_percentage[reverse_order]
+    
+    # Trials: every chest of every condition gets exactly its number of rewards, shuffled along the trials
+    n_rewards = n_rewards[np.stack((learn_order, reverse_order), axis=1)] # (n_subjects, 2, n_chests)
+    trials = (np.arange(n_trials) < n_rewards[..., None]).astype(int)
+    trials = rng.permuted(trials, axis=-1)
+    if max_run_length is not None:
+        redraw = longest_run(trials) > max_run_length
+        for attempt in range(max_attempts):
+            if not redraw.any():
+                break
+            trials[redraw] = rng.permuted(trials[redraw], axis=-1)
+            redraw = longest_run(trials) > max_run_length
+        else:
+            raise ValueError(f"Couldn't keep the runs of identical outcomes under {max_run_length} trials")
+    trials = trials.transpose(0, 1, 3, 2) # (n_subjects, 2, n_trials, n_chests)
+    
+    # Refresh trials: only the best learning chest is rewarded
+    refresh_trials = np.zeros((n_subjects, refresh_n_trials, n_chests), dtype=int)
+    refresh_trials[np.arange(n_subjects), :, learn_positions.argmax(axis=1)] = 1
+    
+    return {'seed': seed, 'learn_positions': learn_positions, 'reverse_positions': reverse_positions,
+            'learn_trials': trials[:, 0], 'reverse_trials': trials[:, 1], 'refresh_trials': refresh_trials}
+
+# Schedule files: a versioned .npz with a JSON header (version, seed and a checksum of every array)
+SCHEDULE_VERSION = 1
+SCHEDULE_ARRAYS = ['learn_positions', 'learn_trials', 'refresh_trials', 'reverse_positions', 'reverse_trials']
+
+def array_checksum(array):
+    return hashlib.sha256(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+def save_schedule(schedule_file, schedule):
+    # Write the schedule of one subject. The file is written aside and then linked into place, so it is either complete
+    # or absent, and an existing schedule is never replaced. On filesystems without hard links (FAT/exFAT drives, some 
+    # SMB shares) the name is claimed with an exclusive create and the complete file is moved over it instead (it is 
+    # empty for that moment).
+    if os.path.exists(schedule_file):
+        raise FileExistsError(f"{schedule_file} already exists")
+    os.makedirs(os.path.dirname(schedule_file) or '.', exist_ok=True)
+    arrays = {name: np.asarray(schedule[name]) for name in SCHEDULE_ARRAYS}
+    header = {'version': SCHEDULE_VERSION, 'seed': schedule['seed'], 
+              'checksums': {name: array_checksum(array) for name, array in arrays.items()}}
+    temp_file = schedule_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        np.savez(f, header=np.frombuffer(json.dumps(header).encode(), dtype=np.uint8), **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        try:
+            os.link(temp_file, schedule_file)
+        except FileExistsError:
+            raise
+        except OSError:
+            os.close(os.open(schedule_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            os.replace(temp_file, schedule_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+def load_schedule(schedule_file):
+    # Read a schedule saved by save_schedule, checking its version and the checksum of every array (a missing file raises
+    # FileNotFoundError, a damaged one ValueError)
+    try:
+        with np.load(schedule_file, allow_pickle=False) as data:
+            header = json.loads(data['header'].tobytes())
+            if header.get('version') != SCHEDULE_VERSION:
+                raise ValueError(f"unsupported version {header.get('version')}")
+            schedule = {'seed': header['seed']}
+            for name in SCHEDULE_ARRAYS:
+                schedule[name] = data[name]
+                if array_checksum(schedule[name]) != header['checksums'][name]:
+                    raise ValueError(f"checksum mismatch in {name}")
+    except FileNotFoundError:
+        raise
+    except (ValueError, KeyError, OSError, zipfile.BadZipFile) as e:
+        raise ValueError(f"Corrupt schedule file {schedule_file}: {e}")
+    return schedule
+
+def convert_metadata(metadata_file, schedule_file=None):
+    # Convert a schedule saved in the previous text format (Python lists separated by ';') without evaluating it.
+    # If part 1 was started twice the file has more than one data line, and the first one (used by part 2) is kept.
+    if schedule_file is None:
+        schedule_file = metadata_file.replace('_metadata_part_', '_schedule_').replace('.txt', '.npz')
+    with open(metadata_file, 'r') as f:
+        f.readline() # header
+        fields = f.readline().strip().split(';')
+    # Values written by numpy 2 look like np.int64(1)
+    fields = [ast.literal_eval(re.sub(r'np\.\w+\(([^()]*)\)', r'\1', field)) for field in fields]
+    schedule = dict(zip(SCHEDULE_ARRAYS, fields[:5]))
+    schedule['seed'] = fields[5] if len(fields) > 5 else None
+    save_schedule(schedule_file, schedule)
+    return schedule_file
+
+def convert_metadata_tree(results_dir='results'):
+    # One-shot conversion of every previous metadata file under results_dir that has no schedule file yet
+    for folder, _, files in os.walk(results_dir):
+        for name in sorted(files):
+            if '_metadata_part_' in name and name.endswith('.txt'):
+                metadata_file = os.path.join(folder, name)
+                schedule_file = metadata_file.replace('_metadata_part_', '_schedule_').replace('.txt', '.npz')
+                if not os.path.exists(schedule_file):
+                    print(f"{metadata_file} -> {convert_metadata(metadata_file, schedule_file)}")
+
+def cohort_seeds(seed, n_subjects):
+    # One seed per subject, from independent streams spawned from the cohort seed
+    return [int(child.generate_state(1, np.uint64)[0]) for child in np.random.SeedSequence(seed).spawn(n_subjects)]
+
+def cohort_subject_ids(n_subjects, width=5):
+    # Subject IDs s00001, s00002, ... with the same width whatever the size of the cohort, so the IDs of separate runs 
+    # sort and match alike
+    if n_subjects >= 10 ** width:
+        raise ValueError(f"{n_subjects} subjects don't fit in IDs of {width} digits")
+    return [f"s{i + 1:0{width}d}" for i in range(n_subjects)]
+
+def assign_conditions(n_subjects, seed):
+    # Counterbalanced conditions: each consecutive pair of subjects gets A and B, in random order
+    rng = np.random.default_rng(seed)
+    pairs = rng.permuted(np.tile([0, 1], ((n_subjects + 1) // 2, 1)), axis=1).ravel()[:n_subjects]
+    return [['A', 'B'][i] for i in pairs]
+
+def assign_positions(conditions, seed, n_chests=3):
+    # Counterbalanced chest positions: within each condition, every consecutive block of n_chests! subjects gets each 
+    # learning order once (in random order) and a single reversal shift, and consecutive blocks take every shift once (in
+    # random order). A shift maps the learning orders one to one onto the reverse ones, so both positions are balanced:
+    # their counts differ by at most one within each condition. Returns the learn_order and shift of generate_trials.
+    rng = np.random.default_rng([seed, 1]) # Independent of the streams of the conditions and of the subjects
+    orders = np.array(list(itertools.permutations(range(n_chests))))
+    conditions = np.asarray(conditions)
+    learn_order = np.zeros((len(conditions), n_chests), dtype=int)
+    shift = np.zeros(len(conditions), dtype=int)
+    for condition in sorted(set(conditions.tolist())):
+        subjects = np.flatnonzero(conditions == condition)
+        n_blocks = -(-len(subjects) // len(orders))
+        blocks = rng.permuted(np.tile(np.arange(len(orders)), (n_blocks, 1)), axis=1).ravel()
+        shifts = rng.permuted(np.tile(np.arange(1, n_chests), (-(-n_blocks // (n_chests - 1)), 1)), axis=1).ravel()
+        learn_order[subjects] = orders[blocks[:len(subjects)]]
+        shift[subjects] = np.repeat(shifts[:n_blocks], len(orders))[:len(subjects)]
+    return learn_order, shift
+
+def save_cohort_schedules(jobs, results_dir='results'):
+    # Generate and save the schedules of a list of (subject_id, condition, seed, learn_order, shift), as part 1 of the 
+    # task would. Subjects that already have a schedule (in either condition) keep it. Returns the condition, the learning
+    # and reverse chest positions of each subject and whether its schedule is new.
+    conditions, learn_positions, reverse_positions, new = [], [], [], []
+    for subject_id, condition, seed, learn_order, shift in jobs:
+        schedule_files = {c: f"{results_dir}/{subject_id}/{subject_id}_schedule_{c}.npz" for c in ['A', 'B']}
+        existing = [c for c, schedule_file in schedule_files.items() if os.path.exists(schedule_file)]
+        if existing:
+            condition = existing[0]
+            schedule = load_schedule(schedule_files[condition])
+        else:
+            schedules = generate_trials(1, seed, max_run_length=MonetaryIncentiveDelayTask.max_run_length, 
+                                        learn_order=[learn_order], shift=[shift])
+            schedule = {name: value if name == 'seed' else value[0] for name, value in schedules.items()}
+            save_schedule(schedule_files[condition], schedule)
+        conditions.append(condition)
+        learn_positions.append(schedule['learn_positions'])
+        reverse_positions.append(schedule['reverse_positions'])
+        new.append(not existing)
+    return np.array(conditions), np.array(learn_positions), np.array(reverse_positions), np.array(new)
+
+def permutation_balance(positions, conditions):
+    # Count of each chest permutation (reward percentage of the left, middle and right chests) per condition, and the 
+    # chi-square statistic of the counts against a uniform distribution over the 6 permutations (5 degrees of freedom)
+    labels = ['/'.join(str(round(100 * p)) for p in row) for row in positions]
+    permutations = ['/'.join(str(round(100 * p)) for p in row) for row in itertools.permutations(sorted(positions[0], reverse=True))]
+    balance = {}
+    for condition in sorted(set(conditions)):
+        in_condition = [label for label, c in zip(labels, conditions) if c == condition]
+        counts = {p: in_condition.count(p) for p in permutations}
+        expected = len(in_condition) / len(permutations)
+        chi2 = sum((count - expected) ** 2 / expected for count in counts.values())
+        balance[condition] = {'n': len(in_condition), 'counts': counts, 'chi2': round(float(chi2), 3)}
+    return balance
+
+def generate_cohort(subject_ids, results_dir='results', seed=None, workers=None, chunk_size=500):
+    """
+    Create the schedules of a cohort before the sessions, in the files part 1 and part 2 of the task read. Conditions 
+    A/B are counterbalanced in consecutive pairs, the chest positions of the new schedules are counterbalanced within 
+    each condition (see assign_positions), each subject gets its own seed (spawned from the cohort seed, and saved
+    with the schedule, so the SOAs also differ between subjects), and the schedules are generated in a process pool.
+    The assignments are appended to results_dir/cohort_assignments.txt and the balance of the chest permutations across 
+    conditions is printed. A RuntimeError is raised if the new schedules are not balanced.
+    
+        subject_ids (list): Subject IDs.
+        results_dir (str): Results tree where the schedules are saved.
+        seed (int): Cohort seed (a new one is drawn when not given).
+        workers (int): Processes of the pool (one per CPU by default).
+        chunk_size (int): Subjects per task of the pool.
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    conditions = assign_conditions(len(subject_ids), seed)
+    # The chest positions are counterbalanced among the subjects without a schedule (the others keep theirs)
+    has_schedule = np.array([any(os.path.exists(f"{results_dir}/{subject_id}/{subject_id}_schedule_{c}.npz") for c in ['A', 'B']) 
+                             for subject_id in subject_ids], dtype=bool)
+    learn_order = np.zeros((len(subject_ids), 3), dtype=int)
+    shift = np.ones(len(subject_ids), dtype=int)
+    learn_order[~has_schedule], shift[~has_schedule] = assign_positions(np.array(conditions)[~has_schedule], seed)
+    jobs = list(zip(subject_ids, conditions, cohort_seeds(seed, len(subject_ids)), learn_order.tolist(), shift.tolist()))
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(save_cohort_schedules, chunks, [results_dir] * len(chunks)))
+    conditions, learn_positions, reverse_positions, new = [np.concatenate(arrays) for arrays in zip(*results)]
+    elapsed = time.perf_counter() - start
+    
+    # Assignments of the new schedules
+    assignments_file = os.path.join(results_dir, 'cohort_assignments.txt')
+    write_header = not os.path.exists(assignments_file)
+    with open(assignments_file, 'a') as f:
+        if write_header:
+            f.write('subject_id;condition;seed;cohort_seed\n')
+        for (subject_id, condition, subject_seed, *_), is_new in zip(jobs, new):
+            # Subjects that already had a schedule keep their condition and seed
+            if is_new:
+                f.write(f"{subject_id};{condition};{subject_seed};{seed}\n")
+    
+    balance = {'learn': permutation_balance(learn_positions, conditions), 
+               'reverse': permutation_balance(reverse_positions, conditions)}
+    print(f"{int(new.sum())} schedules created, {int((~new).sum())} already existed ({elapsed:.2f} s), cohort seed {seed}")
+    for phase, by_condition in balance.items():
+        for condition, stats in by_condition.items():
+            counts = ', '.join(f"{p}: {count}" for p, count in stats['counts'].items())
+            print(f"{phase} positions, condition {condition} ({stats['n']} subjects): {counts} (chi2 = {stats['chi2']}, df = 5)")
+    
+    # The counts of the new schedules differ by at most one in every condition
+    if new.any():
+        for phase, positions in [('learn', learn_positions), ('reverse', reverse_positions)]:
+            for condition, stats in permutation_balance(positions[new], conditions[new]).items():
+                if max(stats['counts'].values()) - min(stats['counts'].values()) > 1:
+                    raise RuntimeError(f"The {phase} positions of the new schedules of condition {condition} are not balanced: {stats['counts']}")
+    return balance
+
+def assigned_condition(subject_id, results_dir='results'):
+    # Condition of a subject: the one of its schedule (or schedule in the previous text format) if it has one, otherwise
+    # its assignment in results_dir/cohort_assignments.txt (None if it has neither)
+    for condition in ['A', 'B']:
+        for name in [f"{subject_id}_schedule_{condition}.npz", f"{subject_id}_metadata_part_{condition}.txt"]:
+            if os.path.exists(os.path.join(results_dir, subject_id, name)):
+                return condition
+    assignments_file = os.path.join(results_dir, 'cohort_assignments.txt')
+    if os.path.exists(assignments_file):
+        with open(assignments_file) as f:
+            for line in f.read().splitlines()[1:]:
+                fields = line.split(';')
+                if fields[0] == subject_id:
+                    return fields[1]
+    return None
+
+RESULTS_COLUMNS = ['cond', 'trial_n', 'trial_setup', 'chest_latency_ms', 'chest_sel', 'confidence_latency_ms', 'confidence_sel', 'hit', 
+                   'result', 'streak', 'stim_rebuilds', 'fixation_req_ms', 'fixation_ms', 'soa_req_ms', 'soa_ms', 
+                   'feedback_req_ms', 'feedback_ms', 'dropped_frames']
+
+def parse_value(value):
+    # Numbers read back from a results file (anything else, like the trial setup, stays a string)
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+# Typed columnar version of the results (one .npy per part), with the reward of each chest in its own column
+RESULTS_DTYPE = np.dtype([('subject', 'U32'), ('experiment_condition', 'U1'), ('experiment_part', 'i1'), ('cond', 'U8'), ('trial_n', 'i2'),
+                          ('reward_left', 'i1'), ('reward_down', 'i1'), ('reward_right', 'i1'), ('chest_latency_ms', 'i4'), ('chest_sel', 'i1'), 
+                          ('confidence_latency_ms', 'i4'), ('confidence_sel', 'i1'), ('hit', 'i1'), ('result', 'i4'), ('streak', 'i4'), 
+                          ('stim_rebuilds', 'i4'), ('fixation_req_ms', 'f4'), ('fixation_ms', 'f4'), ('soa_req_ms', 'f4'), ('soa_ms', 'f4'), 
+                          ('feedback_req_ms', 'f4'), ('feedback_ms', 'f4'), ('dropped_frames', 'i4')])
+
+def results_dtype(subject_id):
+    # RESULTS_DTYPE with the subject field wide enough for this ID (IDs up to 32 characters keep the common dtype; 
+    # load_results concatenates parts of different widths)
+    return np.dtype([('subject', f"U{max(32, len(subject_id))}")] + [(name, RESULTS_DTYPE[name]) for name in RESULTS_DTYPE.names[1:]])
+
+# A row of the results file: the RESULTS_COLUMNS of a trial in the order of RESULTS_DTYPE (without the subject, condition
+# and part), with the trial setup written as the list of chest rewards
+RESULTS_ROW_FORMAT = '%s;%d;[%d, %d, %d];' + '%d;' * 8 + '%.1f;' * 6 + '%d\n'
+
+def results_to_array(trial_data, subject_id, experiment_condition, experiment_part):
+    # Convert the trial rows of a part to the typed columnar layout
+    results = np.zeros(len(trial_data), dtype=results_dtype(subject_id))
+    results['subject'] = subject_id
+    results['experiment_condition'] = experiment_condition
+    results['experiment_part'] = experiment_part
+    if len(trial_data) == 0:
+        return results
+    columns = list(zip(*trial_data))
+    # The trial setup is a list/array, or its text when the rows were read back from the results file
+    setups = np.array([[int(x) for x in re.findall(r'\d+', setup)] if isinstance(setup, str) else list(setup) for setup in columns[2]])
+    results['reward_left'], results['reward_down'], results['reward_right'] = setups.T
+    for i, name in enumerate(RESULTS_COLUMNS):
+        if name != 'trial_setup':
+            results[name] = columns[i]
+    return results
+
+def save_results_array(results_file, results):
+    # Written aside and moved into place, so the .npy is never left half written
+    temp_file = results_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        np.save(f, results)
+    os.replace(temp_file, results_file)
+
+def load_results(results_dir='results'):
+    # Concatenate the columnar results of every subject and part under results_dir into one array
+    # (each file is memory mapped, so only the concatenated table is read into memory)
+    files = sorted(os.path.join(folder, name) for folder, _, names in os.walk(results_dir) for name in names 
+                   if re.search(r'_part_\d+\.npy$', name))
+    if not files:
+        return np.zeros(0, dtype=RESULTS_DTYPE)
+    return np.concatenate([np.load(results_file, mmap_mode='r', allow_pickle=False) for results_file in files])
+
+class ResultsWriter:
+    """
+    Append-only writer for the results file. Rows (tuples of values, formatted with `row_format`) are queued by the task 
+    and written by a background thread that flushes every row and fsyncs every `fsync_every` rows, so no disk I/O 
+    happens during the timed phases and a crash loses at most the row being written. The complete rows left by a 
+    previous run are in `rows`, so the task can resume.
+    """
+    fsync_every = 10
+    
+    def __init__(self, results_file, columns=RESULTS_COLUMNS, row_format=RESULTS_ROW_FORMAT):
+        self.results_file = results_file
+        self.header = ';'.join(columns)
+        self.row_format = row_format
+        os.makedirs(os.path.dirname(results_file) or '.', exist_ok=True)
+        self.rows = self.read_rows()
+        self.file = open(results_file, 'a')
+        if self.file.tell() == 0:
+            self.file.write(self.header + '\n')
+            self.file.flush()
+        self.queue = collections.deque()
+        self.ready = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.thread.start()
+        
+    def read_rows(self):
+        # Complete rows already in the file. A partial last line (a crash while writing it) is removed.
+        if not os.path.exists(self.results_file):
+            return []
+        with open(self.results_file, 'rb+') as f:
+            content = f.read()
+            complete = content.rfind(b'\n') + 1
+            if complete < len(content):
+                f.truncate(complete)
+        lines = content[:complete].decode().splitlines()
+        if lines and lines[0] != self.header:
+            raise ValueError(f"{self.results_file} has different columns, move it away before running this part again")
+        return [[parse_value(value) for value in line.split(';')] for line in lines if line != self.header]
+    
+    def write(self, row):
+        self.queue.append(row)
+        self.ready.set()
+        
+    def writer_loop(self):
+        # Runs until the writer is closed and every queued row is written (a row queued just before close() is too)
+        n_rows = 0
+        while not (self.closed and not self.queue):
+            self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                row = self.queue.popleft()
+                self.file.write(self.row_format % row)
+                self.file.flush()
+                n_rows += 1
+                if n_rows % self.fsync_every == 0:
+                    os.fsync(self.file.fileno())
+            
+    def close(self):
+        # Write the queued rows and close the file (it can be called more than once)
+        if self.closed:
+            return
+        self.closed = True
+        self.ready.set()
+        self.thread.join()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+class TrialStore:
+    """
+    Trials of a part in a preallocated typed array (RESULTS_DTYPE, see results_dtype), filled as the trials end. The accumulated result, 
+    the streak and the trials of each condition are kept up to date as trials are added, so reading them takes the same 
+    time whatever the number of trials, and the array is saved as the .npy of the part as it is.
+    
+        capacity (int): Trials of the part (the array grows if more are added).
+    """
+    
+    def __init__(self, capacity, subject_id, experiment_condition, experiment_part):
+        self.rows = np.zeros(capacity, dtype=results_dtype(subject_id))
+        self.part = (subject_id, experiment_condition, experiment_part)
+        self.n = 0
+        self.total = 0 # Accumulated result ($)
+        self.streak = 0 # Consecutive rewarded trials
+        self.counts = collections.Counter() # Trials of each condition
+        
+    def __len__(self):
+        return self.n
+    
+    def __getitem__(self, index):
+        return self.rows[:self.n][index]
+    
+    def array(self):
+        # The trials so far (a view)
+        return self.rows[:self.n]
+    
+    def reserve(self, n):
+        if n > len(self.rows):
+            rows = np.zeros(max(n, 2 * len(self.rows)), dtype=self.rows.dtype)
+            rows[:self.n] = self.rows[:self.n]
+            self.rows = rows
+    
+    def add(self, cond, trial_n, reward, chest_latency_ms, chest_sel, confidence_latency_ms, confidence_sel, hit, stim_rebuilds, timing, dropped_frames):
+        # Add a trial (+$10 or -$10) and return its row of the results file (see RESULTS_ROW_FORMAT)
+        self.total += 10 if hit else -10
+        self.streak = self.streak + 1 if hit else 0
+        row = (cond, trial_n, *reward, chest_latency_ms, chest_sel, confidence_latency_ms, confidence_sel, hit, 
+               self.total, self.streak, stim_rebuilds, *timing, dropped_frames)
+        if self.n == len(self.rows):
+            self.reserve(self.n + 1)
+        self.rows[self.n] = self.part + row
+        self.n += 1
+        self.counts[cond] += 1
+        return row
+    
+    def extend(self, results):
+        # Add trials already in the typed layout (e.g. those of an interrupted part), continuing from their total and streak
+        self.reserve(self.n + len(results))
+        self.rows[self.n:self.n + len(results)] = results
+        self.n += len(results)
+        self.counts.update(results['cond'].tolist())
+        if len(results):
+            self.total = int(results['result'][-1])
+            self.streak = int(results['streak'][-1])
+
+# Integer code of each EEG marker, for backends that send numbers instead of text (LSL)
+MARKER_CODES = {'experiment_start': 1, 'experiment_end': 2, 'experiment_halted': 3, 'test_trials_start': 4,
+                'learning_trials_start': 5, 'learning_trials_end': 6, 'refresh_learning_trials_start': 7, 
+                'refresh_learning_trials_end': 8, 'reverse_learning_trials_start': 9, 'reverse_learning_trials_end': 10,
+                'trial_start': 11, 'stimuli_fixation_shown': 12, 'key_pressed_chest': 13, 'key_confidence_selected': 14,
+                'result_fixation_shown': 15, 'feedback_shown': 16, 'trial_end': 17, 'feedback_hit': 18, 'feedback_miss': 19}
+
+class NullMarkerBackend:
+    """
+    Marker backend that sends nothing (debug and simulation).
+    """
+    
+    def connect(self, subject_tag):
+        pass
+    
+    def start_recording(self):
+        pass
+    
+    def stop_recording(self):
+        pass
+    
+    def pause_recording(self):
+        pass
+    
+    def resume_recording(self):
+        pass
+    
+    def send_marker(self, text, annot_type, timestamp):
+        pass
+    
+    def report(self):
+        return {}
+
+class RCSMarkerBackend(NullMarkerBackend):
+    """
+    Annotations through the BrainProducts Remote Control Server. Markers are stamped and queued by the task, and a
+    background thread sends them, so a slow RCS never delays a flip.
+    """
+    # Remote Control Server address (can point to a local fake server for testing, see extras/benchmarks/fake_rcs.py)
+    rcs_host = '127.0.0.1'
+    rcs_port = 6700
+    rcs_timeout = 10.0 # Seconds to wait for the server to acknowledge a command
+    rcs_mode = None # Recorder mode as last set by this interface (None when unknown)
+    workspace = r'C:\Vision\Workfiles\PsiloLearn.rwksp'
+    # Markers waiting to be sent to the RCS (markers beyond this are dropped and counted)
+    marker_queue_size = 256
+    marker_retries = 3
+    # Markers that only feed the online ERP averager (extras/online_erp.py, through LSL). They are not annotated, so the
+    # recordings keep the markers their analysis pipelines parse.
+    online_only_markers = ('feedback_hit', 'feedback_miss')
+    
+    state_timeout = 10.0 # Seconds to wait for the recorder to reach a state
+    
+    def connect(self, subject_tag):
+        # Start the connection to RCS (instead of fixed waits, each step waits until the recorder reports the new state)
+        from psychopy.hardware import brainproducts
+        load_modules()
+        self.rcs = brainproducts.RemoteControlServer(host=self.rcs_host, port=self.rcs_port, timeout=self.rcs_timeout, testMode=False) 
+        self.rcs.openRecorder()
+        self.wait_for_state('applicationState', ['Open'])
+        self.set_rcs_mode('default') # Set the mode to default (aka idle state)
+        self.wait_for_state('acquisitionState', ['Stopped'])
+        # self.rcs.amplifier = 'Simulated Amplifier', 'LA-05490-0200'
+        self.rcs.amplifier = 'BrainAmp Family'
+        self.rcs.open(expName = 'PsiloLearn', participant = subject_tag, workspace = self.workspace)
+        self.wait_for_state('recordingState', ['Idle'])
+        # Start the background sender for the markers
+        self.start_marker_sender()
+        
+    def start_recording(self):   
+        # Set the RCS to recording 
+        self.flush_markers()
+        self.set_rcs_mode('monitor')
+        self.wait_for_state('acquisitionState', ['Running'])
+        self.rcs.startRecording()
+        self.wait_for_state('recordingState', ['Recording', 'Saving calibration'])
+     
+    def stop_recording(self):
+        # Send the pending markers before ending the recording
+        self.flush_markers()
+        # End recording
+        self.rcs.stopRecording()
+        self.set_rcs_mode('default')
+        self.wait_for_state('recordingState', ['Idle'])
+    
+    def pause_recording(self):
+        # Pause recording
+        self.flush_markers()
+        self.rcs.pauseRecording()
+        self.wait_for_state('recordingState', ['Paused', 'Paused calibration'])
+    
+    def resume_recording(self):
+        # Resume recording
+        self.flush_markers()
+        self.rcs.resumeRecording()
+        self.wait_for_state('recordingState', ['Recording', 'Saving calibration'])
+
+    def wait_for_state(self, state, values):
+        # Poll a state reported by the recorder until it has one of the values, returns the time it took
+        start = time.perf_counter()
+        while getattr(self.rcs, state) not in values:
+            if time.perf_counter() - start > self.state_timeout:
+                raise RuntimeError(f"The recorder {state} is {getattr(self.rcs, state)}, not {' or '.join(values)}")
+            time.sleep(0.01)
+        return time.perf_counter() - start
+
+    def send_marker(self, text, annot_type, timestamp):
+        # Queue the marker and return immediately, the sender thread writes the annotation.
+        if text in self.online_only_markers:
+            return
+        if timestamp is None:
+            timestamp = core.getTime()
+        if len(self.marker_queue) >= self.marker_queue_size:
+            self.marker_stats['dropped'] += 1
+            return
+        self.marker_queue.append((text, annot_type, timestamp))
+        self.marker_stats['queued'] += 1
+        self.marker_stats['max_depth'] = max(self.marker_stats['max_depth'], len(self.marker_queue))
+        self.marker_ready.set()
+
+    def start_marker_sender(self):
+        # deque appends and pops are atomic, so the task and the sender share it without locks
+        self.marker_queue = collections.deque()
+        self.marker_ready = threading.Event()
+        self.marker_stats = {'queued': 0, 'sent': 0, 'failed': 0, 'dropped': 0, 'max_depth': 0, 'round_trips': 0}
+        self.marker_latencies = [] # (marker, seconds from its timestamp to the acknowledgement of its annotation)
+        self.marker_sender = threading.Thread(target=self.marker_sender_loop, daemon=True)
+        self.marker_sender.start()
+
+    def marker_sender_loop(self):
+        while True:
+            self.marker_ready.wait()
+            self.marker_ready.clear()
+            while self.marker_queue:
+                # Keep the marker in the queue until it has been handled, so flushing waits for it
+                text, annot_type, timestamp = self.marker_queue[0]
+                for attempt in range(self.marker_retries):
+                    try:
+                        # Write annotation (the mode is tracked locally, so this is a single round trip)
+                        if self.rcs_mode != 'monitor':
+                            self.set_rcs_mode('monitor')
+                            self.marker_stats['round_trips'] += 1
+                        self.marker_stats['round_trips'] += 1
+                        # sendAnnotation only logs a missing acknowledgement, so send it raw and check the reply
+                        message = f"AN:{text};{annot_type}"
+                        if not self.rcs.sendRaw(message, checkOutput=message + ':OK'):
+                            raise IOError('not acknowledged')
+                        self.marker_stats['sent'] += 1
+                        self.marker_latencies.append((text, core.getTime() - timestamp))
+                        break
+                    except Exception as e:
+                        print(f"EEG marker '{text}' failed (attempt {attempt + 1}): {e}")
+                        time.sleep(0.05)
+                        self.resync_rcs_mode()
+                else:
+                    self.marker_stats['failed'] += 1
+                self.marker_queue.popleft()
+
+    def set_rcs_mode(self, mode):
+        # Change the recorder mode and remember it locally, so sending a marker doesn't need to query it
+        self.rcs.mode = mode
+        self.rcs_mode = mode
+
+    def resync_rcs_mode(self):
+        # After an error the local state may be stale, so read the mode back from the server
+        try:
+            self.marker_stats['round_trips'] += 1
+            self.rcs_mode = self.rcs.mode
+        except Exception:
+            self.rcs_mode = None # Unknown, it will be set again before the next annotation
+
+    def flush_markers(self, timeout = 5.0):
+        # Wait until the sender has handled every queued marker (or the timeout expires)
+        deadline = core.getTime() + timeout
+        while self.marker_queue and core.getTime() < deadline:
+            time.sleep(0.001)
+        return len(self.marker_queue) == 0
+
+    def report(self):
+        # Queue depth and send latency (ms) of the markers sent so far
+        report = dict(self.marker_stats, depth=len(self.marker_queue))
+        if self.marker_stats['sent']:
+            report['round_trips_per_marker'] = round(self.marker_stats['round_trips'] / self.marker_stats['sent'], 3)
+        if self.marker_latencies:
+            latencies = np.array([latency for _, latency in self.marker_latencies]) * 1000
+            report.update(latency_mean_ms=round(float(latencies.mean()), 2),
+                          latency_p95_ms=round(float(np.percentile(latencies, 95)), 2),
+                          latency_max_ms=round(float(latencies.max()), 2))
+        return report
+
+class LSLMarkerBackend(NullMarkerBackend):
+    """
+    Markers as int32 codes (MARKER_CODES) on a Lab Streaming Layer outlet, stamped with local_clock() when they are
+    sent (right after the flip, through win.callOnFlip). Any LSL recorder (e.g. LabRecorder) records them in sync with
+    the amplifier stream. Pushing a sample doesn't wait for the network, so no sender thread is needed.
+    """
+    stream_name = 'MID_markers'
+    
+    def connect(self, subject_tag):
+        from pylsl import StreamInfo, StreamOutlet, local_clock
+        self.local_clock = local_clock
+        info = StreamInfo(name=self.stream_name, type='Markers', channel_count=1, nominal_srate=0, 
+                          channel_format='int32', source_id=f"mid_{subject_tag}")
+        # Keep the marker names with the stream, so recordings can be decoded without this file
+        markers_xml = info.desc().append_child("markers")
+        for text, code in MARKER_CODES.items():
+            marker_xml = markers_xml.append_child("marker")
+            marker_xml.append_child_value("label", text)
+            marker_xml.append_child_value("code", str(code))
+        self.outlet = StreamOutlet(info)
+        self.n_sent = 0
+        
+    def send_marker(self, text, annot_type, timestamp):
+        if timestamp is None:
+            timestamp = self.local_clock()
+        self.outlet.push_sample([MARKER_CODES[text]], timestamp)
+        self.n_sent += 1
+        
+    def report(self):
+        return {'sent': self.n_sent}
+
+MARKER_BACKENDS = {'rcs': RCSMarkerBackend, 'lsl': LSLMarkerBackend, 'none': NullMarkerBackend}
 
 class EEGInterface:     
+    """
+    EEG recording control and markers, through one of MARKER_BACKENDS ('rcs' by default, always 'none' in debug mode).
+    Sending each marker is a span of the tracer.
+    """
     debug = False   
+    
+    def __init__(self, marker_backend='rcs', tracer=None):
+        self.marker_backend = marker_backend
+        self.backend = NullMarkerBackend() # Until connected
+        self.tracer = Tracer() if tracer is None else tracer
+    
     def eeg_connect(self, subject_id, experiment_condition, experiment_part):
-        if not self.debug:
-            # Start the connection to RCS        
-            self.rcs = brainproducts.RemoteControlServer(host='127.0.0.1', port=6700, timeout=10.0, testMode=False) 
-            self.rcs.openRecorder()
-            core.wait(1)
-            self.rcs.mode = 'default' # Set the mode to default (aka idle state)
-            core.wait(1)      
-            # self.rcs.amplifier = 'Simulated Amplifier', 'LA-05490-0200'
-            self.rcs.amplifier = 'BrainAmp Family'
-            subject_tag = f"{subject_id}_{experiment_condition}_part_{str(experiment_part)}"
-            self.rcs.open(expName = 'PsiloLearn', participant = subject_tag, workspace = r'C:\Vision\Workfiles\PsiloLearn.rwksp')
-            core.wait(2)    
+        self.backend = MARKER_BACKENDS['none' if self.debug else self.marker_backend]()
+        subject_tag = f"{subject_id}_{experiment_condition}_part_{str(experiment_part)}"
+        self.backend.connect(subject_tag)
         
     def eeg_start_recording(self):   
-        if not self.debug:     
-            # Set the RCS to recording 
-            self.rcs.mode = 'monitor'    
-            self.rcs.startRecording()
-            core.wait(2)
+        self.backend.start_recording()
      
     def eeg_stop_recording(self):
+        self.backend.stop_recording()
         if not self.debug:
-            # End recording
-            self.rcs.stopRecording()
-            self.rcs.mode = 'default'  
-            core.wait(1)
+            print(f"EEG markers: {self.marker_report()}")
     
     def eeg_pause_recording(self):
-        if not self.debug:
-            # Pause recording
-            self.rcs.pauseRecording()
-            core.wait(2)
+        self.backend.pause_recording()
     
     def eeg_resume_recording(self):
-        if not self.debug:
-            # Resume recording
-            self.rcs.resumeRecording()
-            core.wait(1)
+        self.backend.resume_recording()
 
-    def eeg_send_marker(self, text, annot_type = 'ANNOT'):
-        if not self.debug:
-            # Write annotation
-            if self.rcs.mode != 'monitor':
-                self.rcs.mode = 'monitor'                
-            self.rcs.sendAnnotation(text, annot_type)            
+    def eeg_send_marker(self, text, annot_type = 'ANNOT', timestamp = None):
+        # When called through win.callOnFlip this runs right after the flip, so the backend stamps it with the flip time
+        with self.tracer.span(text, 'marker'):
+            self.backend.send_marker(text, annot_type, timestamp)
+        
+    def marker_report(self):
+        return self.backend.report()
+
+class NullWindow:
+    """
+    Stand-in for visual.Window that flips against a virtual clock, so the frame scheduling can run without a display.
+    
+        refresh_rate (float): Simulated refresh rate in Hz.
+        size (tuple): Simulated window size in pixels.
+        paced (bool): If True, each flip waits for the next frame boundary on `clock`, like a display synchronised to 
+            its refresh, and returns that time (for real-time benchmarks).
+        clock (function): Clock used when paced.
+    """
+    
+    def __init__(self, refresh_rate=60.0, size=(1920, 1080), paced=False, clock=time.perf_counter):
+        self.refresh_rate = refresh_rate
+        self.size = np.array(size)
+        self.paced = paced
+        self.clock = clock
+        self.time = clock() if paced else 0.0
+        self.to_call = []
+        
+    def getActualFrameRate(self, *args, **kwargs):
+        return self.refresh_rate
+    
+    def callOnFlip(self, function, *args, **kwargs):
+        self.to_call.append((function, args, kwargs))
+        
+    def flip(self, clearBuffer=True):
+        # Advance one frame and run the functions registered for this flip
+        frame_dur = 1.0 / self.refresh_rate
+        self.time += frame_dur
+        if self.paced:
+            # A late flip waits for the following frame boundary (a dropped frame)
+            now = self.clock()
+            if now > self.time:
+                self.time += np.ceil((now - self.time) / frame_dur) * frame_dur
+            while self.time - self.clock() > 0.002:
+                time.sleep(0.001)
+            while self.clock() < self.time:
+                pass
+        to_call, self.to_call = self.to_call, []
+        for function, args, kwargs in to_call:
+            function(*args, **kwargs)
+        return self.time
+    
+    def close(self):
+        pass
+
+class NullStim:
+    """
+    Stand-in for the PsychoPy stimuli when there is no display: keeps the given parameters as attributes and draws nothing.
+    """
+    
+    def __init__(self, win, **params):
+        self.win = win
+        self.__dict__.update(params)
+        
+    def draw(self, win=None):
+        pass
+
+class FrameScheduler:
+    """
+    Presents each timed phase of a trial for a whole number of frames at the measured refresh rate, instead of sleeping
+    for a wall-clock duration. A phase starts at its first flip and ends at the next flip of the following phase, and
+    the requested duration (s), achieved duration (s) and dropped frames of each phase of the current trial are kept
+    in `phases`. The frame intervals of the timed phases (fixation, SOA and feedback) are stored in a preallocated ring
+    buffer and their dropped frames are counted in `n_dropped`. Each flip and each draw of a phase is a span of the 
+    tracer. Call reset() when the window is flipped outside the scheduler (e.g. instructions between blocks).
+    """
+    refresh_tolerance = 0.002 # An interval longer than a frame plus this tolerance has dropped frames
+    timed_phases = ('fixation', 'soa', 'feedback')
+    
+    def __init__(self, win, refresh_rate=None, buffer_size=2**18, tracer=None):
+        self.win = win
+        self.tracer = Tracer() if tracer is None else tracer
+        if refresh_rate is None:
+            refresh_rate = win.getActualFrameRate()
+        # Use 60 Hz when the refresh rate can't be measured (as in conscious_access.py)
+        self.frame_dur = 1.0 / round(refresh_rate) if refresh_rate else 1.0 / 60.0
+        self.phases = {}
+        self.phase = None # Running phase
+        self.onset = None # Timestamp of its first flip
+        self.n_phase_frames = 0 # Frames of the running phase
+        self.frames_left = 0
+        self.draw = None
+        self.intervals = np.zeros(buffer_size) # Frame intervals (s) of the timed phases
+        self.n_intervals = 0
+        self.n_dropped = 0
+        self.last_flip = None
+        
+    def n_frames(self, duration):
+        return max(1, int(round(duration / self.frame_dur)))
+    
+    def flip(self, phase=None, requested=None):
+        # Flip the window, ending the running phase and starting a new one (or none) at this flip
+        with self.tracer.span(phase or 'flip', 'flip'):
+            t = self.win.flip()
+        self.record(t)
+        if self.phase is not None:
+            self.phases[self.phase][1] = t - self.onset
+        self.phase, self.onset = phase, t
+        if phase is not None:
+            self.phases[phase] = [requested, None, 0]
+        return t
+    
+    def record(self, t):
+        # Store the interval that ends at this flip when it belongs to a timed phase, with the frames it missed
+        if self.phase in self.timed_phases and self.last_flip is not None:
+            interval = t - self.last_flip
+            self.intervals[self.n_intervals % len(self.intervals)] = interval
+            self.n_intervals += 1
+            if interval > self.frame_dur + self.refresh_tolerance:
+                dropped = max(1, int(round(interval / self.frame_dur)) - 1)
+                self.phases[self.phase][2] += dropped
+                self.n_dropped += dropped
+        self.last_flip = t
+    
+    def reset(self):
+        # End the running phase without a flip (the window is about to be flipped outside the scheduler)
+        self.phase = self.onset = self.last_flip = None
+        self.frames_left = 0
+        self.draw = None
+    
+    def frame_intervals(self):
+        # Recorded intervals in order (only the most recent ones if the buffer wrapped around)
+        if self.n_intervals <= len(self.intervals):
+            return self.intervals[:self.n_intervals]
+        return np.roll(self.intervals, -(self.n_intervals % len(self.intervals)))
+    
+    def start(self, phase, duration, draw=None):
+        # Show the first frame of the phase (draw is called before every frame of the phase)
+        self.draw = draw
+        self.n_phase_frames = self.n_frames(duration)
+        self.frames_left = self.n_phase_frames - 1
+        if draw is not None:
+            with self.tracer.span(phase, 'draw'):
+                draw()
+        return self.flip(phase, duration)
+    
+    def hold(self, catch_up=False):
+        # Show the remaining frames of the running phase. With catch_up, the frames that passed while the task worked 
+        # after the first flip (e.g. in the ITI) are skipped, so the phase still ends on time if the work fits in it.
+        while self.frames_left > 0:
+            if self.draw is not None:
+                with self.tracer.span(self.phase, 'draw'):
+                    self.draw()
+            with self.tracer.span(self.phase, 'flip'):
+                t = self.win.flip()
+            self.record(t)
+            if catch_up:
+                self.frames_left = self.n_phase_frames - 1 - int(round((t - self.onset) / self.frame_dur))
+            else:
+                self.frames_left -= 1
+            
+    def show(self, phase, duration, draw=None):
+        onset = self.start(phase, duration, draw)
+        self.hold()
+        return onset
+
+SyntheticKeyPress = collections.namedtuple('SyntheticKeyPress', ['name', 'tDown', 'rt'])
+
+# One trial of the session plan: the reward of each chest, the SOA and, for each chest, its (hit, feedback screen draw,
+# outcome marker)
+TrialPlan = collections.namedtuple('TrialPlan', ['reward', 'soa', 'outcomes'])
+
+class SyntheticKeyboard:
+    """
+    Keyboard fed with programmatic key presses, with the getKeys()/clock interface of psychopy.hardware.keyboard that
+    ResponseCapture uses (for benchmarks and tests without a keyboard).
+    """
+    
+    def __init__(self):
+        load_modules()
+        self.clock = core.Clock()
+        self.presses = collections.deque()
+        self.names = collections.deque()
+        
+    def now(self):
+        # Time in the same base as clock.getLastResetTime()
+        return self.clock.getLastResetTime() + self.clock.getTime()
+        
+    def press(self, name):
+        self.presses.append(self.now())
+        self.names.append(name)
+        
+    def getKeys(self, keyList=None, waitRelease=False, clear=True):
+        # Like psychopy.hardware.keyboard, rt is measured from the last reset of the clock when the keys are read
+        presses = []
+        while self.presses:
+            t_down = self.presses.popleft()
+            presses.append(SyntheticKeyPress(self.names.popleft(), t_down, t_down - self.clock.getLastResetTime()))
+        return presses
+
+class ResponseCapture:
+    """
+    Collects key presses with the time the keyboard received them (psychopy.hardware.keyboard timestamps events in its
+    own queue, with the psychtoolbox backend), so reaction times don't depend on how often the task polls.
+    Register start() with win.callOnFlip: the keyboard clock is reset right after that flip, and once the flip returns
+    set_onset() moves the zero of the reaction times to its timestamp. While a response is awaited, a dedicated thread 
+    drains the keyboard (only when the psychtoolbox backend is available, otherwise the keyboard is polled from wait()).
+    """
+    poll_interval = 0.0005
+    
+    def __init__(self, kb=None, threaded=None):
+        load_modules()
+        self.keyboard = keyboard.Keyboard() if kb is None else kb
+        if threaded is None:
+            threaded = keyboard.havePTB
+        self.presses = collections.deque()
+        self.onset = None
+        self.active = threading.Event()
+        if threaded:
+            self.thread = threading.Thread(target=self.capture_loop, daemon=True)
+            self.thread.start()
+        else:
+            self.thread = None
+            
+    def start(self):
+        # Reset the reaction time clock (at the flip that shows the response screen)
+        self.keyboard.clock.reset()
+        self.onset = self.keyboard.clock.getLastResetTime()
+        self.active.set()
+        
+    def set_onset(self, flip_time):
+        # Measure the reaction times from the flip timestamp returned by win.flip() (logging.defaultClock time) instead of
+        # from start(), which runs after the flip
+        if flip_time is not None:
+            from psychopy import logging
+            self.onset = flip_time + logging.defaultClock.getLastResetTime()
+        
+    def poll(self):
+        # rt is measured from the last reset of the keyboard clock in every keyboard backend (tDown has a different 
+        # zero in each), so the time each key went down is rebuilt from it
+        reset = self.keyboard.clock.getLastResetTime()
+        for press in self.keyboard.getKeys(waitRelease=False):
+            self.presses.append((press.name, reset + press.rt))
+            
+    def capture_loop(self):
+        while True:
+            self.active.wait()
+            self.poll()
+            time.sleep(self.poll_interval)
+            
+    def wait(self, keyList):
+        # Wait for one of the keys pressed after the onset, and return it with its reaction time (s)
+        while True:
+            if self.thread is None:
+                self.poll()
+            while self.presses:
+                name, t_down = self.presses.popleft()
+                if name in keyList and t_down >= self.onset:
+                    self.active.clear()
+                    return name, t_down - self.onset
+            time.sleep(self.poll_interval)
+
+class QLearningResponder:
+    """
+    Synthetic participant for simulations. It chooses chests with a softmax over Q-values learnt with a Rescorla-Wagner
+    update, and reports a higher confidence the higher the Q-value of the chosen chest.
+    
+        alpha (float): Learning rate.
+        beta (float): Inverse temperature of the softmax.
+        seed (int): Seed for the choices.
+    """
+    
+    def __init__(self, alpha=0.3, beta=5.0, seed=None):
+        self.alpha = alpha
+        self.beta = beta
+        self.rng = np.random.default_rng(seed)
+        self.q = np.full(3, 0.5) # Expected reward of each chest
+        self.choice = None
+        
+    def wait_keys(self, keyList=None):
+        # Any key (instructions)
+        if keyList is None:
+            return ['space']
+        # Chest choice
+        if 'left' in keyList:
+            p = np.exp(self.beta * (self.q - self.q.max()))
+            self.choice = self.rng.choice(3, p=p / p.sum())
+            return [['left', 'down', 'right'][self.choice]]
+        # Confidence, from '1' (Bastante) to '4' (Nada)
+        level = min(3, int((1 - self.q[self.choice]) * 4))
+        return [str(level + 1)]
+    
+    def observe(self, chest, hit):
+        self.q[chest] += self.alpha * (hit - self.q[chest])
 
 class MonetaryIncentiveDelayTask:
     """
@@ -60,33 +1283,74 @@ class MonetaryIncentiveDelayTask:
     
     Trials:
         n_trials (int): Number of trials to conduct for each condition.
-        seed_value (int): Seed for the random probability generator (fixed at -1 for replication purposes).
+        seed_value (int): Seed for the schedule and the SOAs (a new one is drawn when not given). It is saved with the 
+            metadata, so part 2 and any replication use the same one.
+        max_run_length (int): Longest allowed run of identical outcomes for a chest (None for no limit).
         learn_trial (dict): Positions of each box in the learning condition.
         reverse_trial (dict): Positions of each box in the reverse condition.    
                             
     EEG signaling:
         marker_duration (float): Duration of the EEG marker (red flash) in seconds.   
+        marker_backend (str): Where the EEG markers go: 'rcs' (BrainProducts Remote Control Server), 'lsl' (Lab Streaming 
+            Layer outlet) or 'none'.
              
     Stimuli timing:
         fixation_time (float): Time for the fixation cross in seconds.
         soa_time (float): Stimulus onset asynchrony (variable for evoked potentials).
         result_time (float): Time for the result to be shown in seconds.
         iti_time (float): Inter-trial interval in seconds.
+        
+    Simulation:
+        responder (object): Synthetic participant (e.g. QLearningResponder). When given, the task runs without a display
+            or amplifier: windows and stimuli are replaced by NullWindow/NullStim, key presses come from the responder
+            and the EEG interface runs in debug mode.
+        results_dir (str): Folder where the metadata and results are saved.
+        
+    Profiling:
+        trace (bool): Record the spans of the trials (phases, draws, flips, response waits and markers) with a Tracer, 
+            and save them at the end of each part as a Chrome trace ('..._trace.json') and percentiles ('..._trace.txt').
+        realtime (bool): During the learning and reverse learning blocks, turn off the garbage collector (it collects in 
+            the ITI instead) and raise the priority of the process (see RealtimeMode).
+        realtime_cpu (int): CPU to pin the task to in real-time mode (None to leave the affinity).
     """
             
-    def __init__(self, subject_id, experiment_condition, experiment_part):     
-        # A value of -1 fixes seed for debug and replication purposes        
-        seed_value = int(time.time())
-        if (seed_value > 0):            
-            random.seed(seed_value)        
+    max_run_length = None
+    trace = False
+    realtime = False
+    realtime_cpu = None
+    chest_keys = {'left': 0, 'down': 1, 'right': 2}
+    chest_key_list = ('left', 'down', 'right', 'escape')
+    confidence_key_list = ('1', '2', '3', '4', 'escape')
+    part_conditions = {1: ('test', 'learn'), 2: ('refresh', 'reverse')} # Blocks of each part, in the order they run
+    image_assets = ['assets/chest_2.png', 'assets/key_left.png', 'assets/key_down.png', 'assets/key_right.png', 
+                    'assets/key_1.png', 'assets/key_2.png', 'assets/key_3.png', 'assets/key_4.png']
+            
+    def __init__(self, subject_id, experiment_condition, experiment_part, responder=None, results_dir='results', seed_value=None, marker_backend='rcs'):     
+        # Synthetic participant (simulation mode)
+        self.responder = responder
+        self.simulate = responder is not None
+        
+        # PsychoPy is imported here, on the main thread (the windows and pyglet need it)
+        self.startup = startup_timer
+        self.startup.time('load_modules', load_modules)
+        
+        # Spans of the trials (a disabled tracer records nothing) and real-time mode of the trial blocks
+        self.tracer = Tracer(self.trace)
+        self.realtime_mode = RealtimeMode(self.realtime, self.realtime_cpu)
         
         # Init the interface to the EEG
-        self.eeg_interface = EEGInterface()
+        self.eeg_interface = EEGInterface(marker_backend, self.tracer)
+        self.eeg_interface.debug = self.simulate
+        
+        # The condition must be the one of the subject's schedule or cohort assignment (see generate_cohort)
+        condition = assigned_condition(subject_id, results_dir)
+        if condition is not None and condition != experiment_condition:
+            raise ValueError(f"Subject {subject_id} is assigned to condition {condition}, not {experiment_condition}")
         
         # Define experiment variables:
-        self.trial_data = []
-        self.metadata_file = f"results/{subject_id}/{subject_id}_metadata_part_{(experiment_condition)}.txt"
-        self.results_file = f"results/{subject_id}/{subject_id}_{experiment_condition}_part_{str(experiment_part)}.txt"
+        self.schedule_file = f"{results_dir}/{subject_id}/{subject_id}_schedule_{experiment_condition}.npz"
+        self.metadata_file = f"{results_dir}/{subject_id}/{subject_id}_metadata_part_{(experiment_condition)}.txt" # Previous (text) format of the schedule
+        self.results_file = f"{results_dir}/{subject_id}/{subject_id}_{experiment_condition}_part_{str(experiment_part)}.txt"
         self.subject_id = subject_id
         self.experiment_condition = experiment_condition
         self.experiment_part = int(experiment_part)        
@@ -99,123 +1363,127 @@ class MonetaryIncentiveDelayTask:
             # Define the reward for the test chests:        
             self.test_trial = [[0, 0, 0], [1, 1, 1]] # Fixed results. The first one is a -1, the second one a +1
 
-            # Generate the positions for the learning and reverse conditions (learn and reverse trials must have their chests in different positions)
-            learn_chest_positions, reverse_chest_positions = self.get_chest_positions(reward_percentage=[0.8, 0.5, 0.2]) # 80%, 50%, 20% of getting a reward (1)
-            # Generate the refresh trials
-            refresh_trials = self.generate_refresh_trials(refresh_n_trials, learn_chest_positions)
-            
-            # Generate the whole trials for the learning and reverse learning chests.        
-            self.learn_trial, self.reverse_trial = self.generate_trials(self.n_trials, learn_chest_positions, reverse_chest_positions)
+            if os.path.exists(self.schedule_file):
+                # Part 1 was already started for this subject: keep the schedule that part 2 will read
+                schedule = self.read_metadata()
+            else:
+                # Generate the whole schedule: chest positions (learn and reverse trials have their chests in different positions), 
+                # learning, refresh and reverse learning trials
+                if seed_value is None:
+                    seed_value = np.random.SeedSequence().entropy
+                schedules = generate_trials(1, seed_value, self.n_trials, refresh_n_trials, 
+                                            reward_percentage=[0.8, 0.5, 0.2], max_run_length=self.max_run_length) # 80%, 50%, 20% of getting a reward (1)
+                schedule = {name: value if name == 'seed' else value[0] for name, value in schedules.items()}
+                # Save general information about the experiment
+                self.save_metadata(schedule)
         elif (experiment_part == 2):
-            # Read the metadata from the previous part
-            metadata = self.read_metadata()
-            
-            # Extract the chest positions and trials from the metadata
-            learn_chest_positions = metadata[0]
-            self.learn_trial = metadata[1]
-            self.refresh_trials = metadata[2]
-            reverse_chest_positions = metadata[3]
-            self.reverse_trial = metadata[4]            
+            # Read the schedule saved by the previous part
+            schedule = self.read_metadata()
+        self.learn_trial = schedule['learn_trials']
+        self.refresh_trials = schedule['refresh_trials']
+        self.reverse_trial = schedule['reverse_trials']
+        seed_value = schedule['seed']
+        
+        # The SOAs of each part come from their own stream of the session seed
+        self.seed_value = seed_value
+        self.rng = np.random.default_rng(None if seed_value is None else [seed_value, self.experiment_part])
                     
         # Define visual variables:
-        self.win = visual.Window(fullscr=True, allowGUI=False, color='gainsboro', monitor='2', screen=1) # experimental window
-        self.win_eeg_markers = visual.Window(size=(800, 600), color='black', units='pix') # eeg markers window        
+        self.eeg_connection = None
+        self.image_cache = {}
+        if self.simulate:
+            self.win = NullWindow() 
+            self.win_eeg_markers = NullWindow()
+        else:
+            # The image decoding runs in a background thread while the windows open (the windows and their textures need 
+            # the main thread)
+            images = self.startup.submit('decode_images', self.decode_images, self.image_assets)
+            self.win = self.startup.time('window', visual.Window, fullscr=True, allowGUI=False, color='gainsboro', monitor='2', screen=1) # experimental window
+            self.win_eeg_markers = self.startup.time('eeg_window', visual.Window, size=(800, 600), color='black', units='pix') # eeg markers window        
+            self.image_cache = images.result()
         self.clock = core.Clock() # clock for timing the markers
-        self.fixation_cross = visual.TextStim(self.win, text='+', color='black', height=0.2)
+        self.responses = None if self.simulate else ResponseCapture() # timestamped key presses
+        self.scheduler = FrameScheduler(self.win, tracer=self.tracer) # frame-locked timing of the trial phases
+        
+        # Build every stimulus used during the trials once, before the first trial starts, and plan every trial
+        self.startup.time('preload_stimuli', self.preload_stimuli)
+        self.make_session_plan()
         
-        # Save general information about the experiment
-        if (self.experiment_part == 1): 
-            self.save_metadata([learn_chest_positions, self.learn_trial, refresh_trials, reverse_chest_positions, self.reverse_trial])
+        # Results are written as the trials end. If this part was interrupted, continue after its last complete trial.
+        self.results_writer = ResultsWriter(self.results_file)
+        self.trial_data = TrialStore(sum(len(plan) for plan in self.plan.values()), subject_id, experiment_condition, self.experiment_part)
+        self.trial_data.extend(results_to_array(self.results_writer.rows, subject_id, experiment_condition, self.experiment_part))
+        if self.trial_data:
+            self.set_text(self.stimuli['total'], '$' + str(self.trial_data.total))
+        # Frame and trace files of this run. Those of an earlier run of the part (interrupted or not) are kept, and this 
+        # run writes its own with a suffix (_run2, _run3, ...)
+        base = os.path.splitext(self.results_file)[0]
+        self.run_base, run = base, 1
+        while os.path.exists(self.run_base + '_frames.txt'):
+            run += 1
+            self.run_base = f"{base}_run{run}"
+        
+        # Everything else is ready, so start the EEG connection (the recorder is only opened once nothing here can fail).
+        # It runs in a background thread while the operator confirms it, see connect_eeg.
+        if not self.simulate:
+            self.eeg_connection = self.startup.submit('eeg_connect', self.eeg_interface.eeg_connect, subject_id, experiment_condition, self.experiment_part)
+
                  
-    def get_chest_positions(self, reward_percentage):
-        # Create a copy of the original probabilities
-        learn_probability = reward_percentage.copy()    
-        reverse_probability = reward_percentage.copy()
-        # Now randomize the probabilities of the chests until all probabilities are different for each position
-        sorted = False
-        while not sorted:
-            random.shuffle(learn_probability)
-            random.shuffle(reverse_probability)
-            if (learn_probability[0] != reverse_probability[0] and 
-                learn_probability[1] != reverse_probability[1] and 
-                learn_probability[2] != reverse_probability[2]):                
-                sorted = True
-
-        return learn_probability, reverse_probability
-     
-    def generate_trials(self, n_trials, learn_probability, reverse_probability):
-        # Generate the trials for the learning and reverse conditions                      
-        probability_array = [learn_probability, reverse_probability]
-        result_array = []
-        for i in range(2):              
-            # First chest reward possibilities (amount of 1s and 0s in the array)
-            chest1_ones = int(n_trials * probability_array[i][0])
-            chest1_zeros = int(n_trials * round(1-probability_array[i][0], 1))
-            # Second chest reward  possibilities (amount of 1s and 0s in the array)
-            chest2_ones = int(n_trials * probability_array[i][1])
-            chest2_zeros = int(n_trials * round(1-probability_array[i][1], 1))
-            # Third chest reward  possibilities (amount of 1s and 0s in the array)
-            chest3_ones = int(n_trials * probability_array[i][2])
-            chest3_zeros = int(n_trials * round(1-probability_array[i][2], 1))
-                    
-            # Create the arrays for each chest
-            # The first position accounts for the 1 and the second for the 0
-            first_chest_array = [1] * chest1_ones + [0] * chest1_zeros
-            second_chest_array = [1] * chest2_ones + [0] * chest2_zeros
-            third_chest_array = [1] * chest3_ones + [0] * chest3_zeros
-                            
-            # Shuffle the arrays
-            np.random.shuffle(first_chest_array)
-            np.random.shuffle(second_chest_array)
-            np.random.shuffle(third_chest_array)
-            
-            # Create the trial array, that includes the three chests
-            trial_array = np.stack((first_chest_array, second_chest_array, third_chest_array), axis=1)
-            result_array.append(trial_array)
-                    
-        # Return the two equally distributed conditions
-        learn_trial = result_array[0]
-        reverse_trial = result_array[1]
-        return learn_trial, reverse_trial
-    
-    def generate_refresh_trials(self, n_trials, learn_chest_positions):
-        position = learn_chest_positions.index(0.8)
-        refresh_trial = [0] * 3
-        refresh_trial[position] = 1
-        result_array = []
-        for i in range(n_trials):
-            result_array.append(refresh_trial)   
-        return result_array
-    
     def show_text(self, text, timeout=0):
         instruction_text = text
-        instructions = visual.TextStim(self.win, text=instruction_text, color='black', height=0.07, wrapWidth=1.7, alignText='left')
+        instructions = self.make_stim(visual.TextStim, text=instruction_text, color='black', height=0.07, wrapWidth=1.7, alignText='left')
         instructions.draw()
+        self.scheduler.reset()
         self.win.flip()
-        if timeout > 0:
+        if timeout > 0 and not self.simulate:
             core.wait(timeout)
-        event.waitKeys()
+        self.wait_keys()
+
+    def wait_keys(self, keyList=None):
+        # Wait for a key press, or ask the synthetic participant for one when simulating
+        if self.simulate:
+            return self.responder.wait_keys(keyList)
+        return event.waitKeys(keyList=keyList)
+    
+    def start_response(self):
+        # Start collecting the response at the next flip
+        if not self.simulate:
+            self.win.callOnFlip(self.responses.start)
+    
+    def set_response_onset(self, flip_time):
+        # Measure the reaction time from the timestamp of the flip registered with start_response
+        if not self.simulate:
+            self.responses.set_onset(flip_time)
+    
+    def get_response(self, keyList):
+        # Key pressed and its reaction time (s) from the flip registered with start_response
+        if self.simulate:
+            return self.responder.wait_keys(keyList)[0], 0.0
+        return self.responses.wait(keyList)
 
     def run_test_trials(self):
         # Test trials
         self.eeg_interface.eeg_send_marker('test_trials_start') # EEG marker   
-        for i in range(len(self.test_trial)):
-            self.run_trial('test', i+1, self.test_trial[i])
+        for i in range(self.completed_trials('test'), len(self.test_trial)):
+            self.run_trial('test', i+1)
             
     def run_learning_trials(self):
         # Start the EEG recording        
         self.eeg_interface.eeg_start_recording()
         try:
+            self.realtime_mode.start()
             self.eeg_interface.eeg_send_marker('experiment_start') # EEG marker  
             
             # Learning trials
             self.eeg_interface.eeg_send_marker('learning_trials_start') # EEG marker                     
-            for i in range(self.n_trials):
-                self.run_trial('learn', i+1, self.learn_trial[i]) # Pass the estimated reward of each trial as a parameter
+            for i in range(self.completed_trials('learn'), self.n_trials):
+                self.run_trial('learn', i+1)
             self.eeg_interface.eeg_send_marker('learning_trials_end') # EEG marker                        
         finally:
             # No matter what, this is allways executed:
+            self.realtime_mode.stop()
             self.save_results()             
+            self.save_frame_report()
             self.eeg_interface.eeg_send_marker('experiment_end') # EEG marker  
             self.eeg_interface.eeg_stop_recording()   
    
@@ -223,29 +1491,43 @@ class MonetaryIncentiveDelayTask:
         # Start the EEG recording     
         self.eeg_interface.eeg_start_recording()
         try:
+            self.realtime_mode.start()
             self.eeg_interface.eeg_send_marker('experiment_start') # EEG marker
               
             # Refresh learning
             self.eeg_interface.eeg_send_marker('refresh_learning_trials_start') # EEG marker
-            for i in range(len(self.refresh_trials)):
-                self.run_trial('refresh', i+1, self.refresh_trials[i]) # Pass the estimated reward of each trial as a parameter            
+            for i in range(self.completed_trials('refresh'), len(self.refresh_trials)):
+                self.run_trial('refresh', i+1)
             self.eeg_interface.eeg_send_marker('refresh_learning_trials_end') # EEG marker                    
                       
             # Reverse learning trials
             self.eeg_interface.eeg_send_marker('reverse_learning_trials_start') # EEG marker
-            for i in range(self.n_trials):
-                self.run_trial('reverse', i+1, self.reverse_trial[i]) # Pass the estimated reward of each trial as a parameter            
+            for i in range(self.completed_trials('reverse'), self.n_trials):
+                self.run_trial('reverse', i+1)
             self.eeg_interface.eeg_send_marker('reverse_learning_trials_end') # EEG marker  
         finally:
             # No matter what, this is allways executed:
+            self.realtime_mode.stop()
             self.save_results()             
+            self.save_frame_report()
             self.eeg_interface.eeg_send_marker('experiment_end') # EEG marker
             self.eeg_interface.eeg_stop_recording()            
                     
+    def connect_eeg(self):
+        # Wait for the EEG connection started in __init__ (errors in the connection are raised here)
+        if self.eeg_connection is None:
+            self.eeg_interface.eeg_connect(self.subject_id, self.experiment_condition, self.experiment_part)
+            return
+        if not self.eeg_connection.done():
+            self.make_stim(visual.TextStim, text='Conectando el EEG...', color='black', height=0.07).draw()
+            self.win.flip()
+        self.startup.time('wait_eeg_connect', self.eeg_connection.result)
+        print(self.startup.report())
+
     def run(self):
-        # Connect EEG    
-        self.show_text('Presioná una tecla para conectar el EEG...', 0)            
-        self.eeg_interface.eeg_connect(self.subject_id, self.experiment_condition, self.experiment_part)              
+        # Connect EEG (the connection started in __init__, the operator confirms it here)
+        self.show_text('Presioná una tecla para conectar el EEG...', 0)
+        self.connect_eeg()
          
         if (self.experiment_part == 1):
             self.show_text('¡Bienvenidx!\n\n'
@@ -295,217 +1577,332 @@ class MonetaryIncentiveDelayTask:
             self.show_text('¡Lo hiciste perfecto! Muchas gracias por participar :)\n\n\n\n'                      
                             'Presiona cualquier tecla para finalizar.')
         
-    def run_trial(self, cond, trial_n, trial_reward):
+    def run_trial(self, cond, trial_n):
         # Each trial is performed as follows
         # [fixation_stimuli + stimuli] [confidence] [fixation_result + result] [iti]
+        # The timed phases last a whole number of frames (see FrameScheduler)
+        plan = self.plan[cond][trial_n - 1] # Rewards, SOA and feedback of this trial (see make_session_plan)
+        trial_reward = plan.reward
         
         fixation_time = 1.5 # Time for the fixation cross. 
-        soa_time = random.uniform(1, 4) # Time before the result is shown
+        soa_time = plan.soa # Time before the result is shown
         result_time = 1 # Time for the result to be shown
         iti_time = 0.5 # Interval between trials
         
-        # Handle the counter for the total gain-loss result:
-        def calc_result(self, hit): 
-            # Get the last count
-            n = int(self.trial_data[-1][8]) if len(self.trial_data) > 0 else 0
-            # Evaluate whether to add or subtract and return
-            res = n+10 if hit == 1 else n-10 
-            return res
-                        
         self.eeg_interface.eeg_send_marker('trial_start') # EEG marker
+        self.stim_rebuilds = 0 # Stimuli created or re-rendered by the task during this trial (only the new total, in the ITI)
                 
         """
         # Fixation cross red test
         self.red_background = visual.Rect(self.win, width=self.win.size[0], height=self.win.size[1], fillColor='red', lineColor=None)
         self.red_background.draw()                
         """
-        self.fixation_cross.draw()        
+        span = self.tracer.span
         self.win.callOnFlip(self.eeg_interface.eeg_send_marker, 'stimuli_fixation_shown') # EEG marker   
-        self.win.flip() 
-        core.wait(fixation_time) 
+        with span('fixation', 'phase'):
+            self.scheduler.show('fixation', fixation_time, self.fixation_cross.draw)
         
-        # Create and show the chests
-        self.draw_chests()
-        self.win.flip()
-        start_time = core.getTime()
-        keys = event.waitKeys(keyList=['left', 'down', 'right', 'escape'])
-        if keys[0] == 'escape':                
+        # Create and show the chests (the latency is measured from this flip)
+        with span('draw_chests', 'draw'):
+            self.draw_chests()
+        self.start_response()
+        self.set_response_onset(self.scheduler.flip())
+        with span('chest_response', 'wait'):
+            key, latency = self.get_response(keyList=self.chest_key_list)
+        if key == 'escape':                
             self.eeg_interface.eeg_send_marker('experiment_halted') # EEG marker
+            self.save_results()
             core.quit()            
-        elif keys[0] in ['left', 'down', 'right']:
-            selected_chest = ['left', 'down', 'right'].index(keys[0]) # returns 0, 1, 2
-            chest_latency = int((core.getTime() - start_time) * 1000)                
+        elif key in self.chest_keys:
+            selected_chest = self.chest_keys[key] # returns 0, 1, 2
+            chest_latency = round(latency * 1000)                
             self.eeg_interface.eeg_send_marker('key_pressed_chest') # EEG marker         
         
         # Ask for the confidence level
-        self.draw_confidence_scale()
-        self.win.flip()  
-        start_time = core.getTime()
-        keys = event.waitKeys(keyList=['1', '2', '3', '4', 'escape'])
-        if keys[0] == 'escape':                                
+        with span('draw_confidence_scale', 'draw'):
+            self.draw_confidence_scale()
+        self.start_response()
+        self.set_response_onset(self.scheduler.flip())
+        with span('confidence_response', 'wait'):
+            key, latency = self.get_response(keyList=self.confidence_key_list)
+        if key == 'escape':                                
             self.eeg_interface.eeg_send_marker('experiment_halted') # EEG marker
+            self.save_results()
             core.quit()    
-        elif keys[0] in ['1', '2', '3', '4']:       
-                selected_confidence = keys[0]
-                confidence_latency = int((core.getTime() - start_time) * 1000)                                    
-                self.eeg_interface.eeg_send_marker('key_confidence_selected') # EEG marker
+        else:
+            selected_confidence = key
+            confidence_latency = round(latency * 1000)                                    
+            self.eeg_interface.eeg_send_marker('key_confidence_selected') # EEG marker
 
         ## RESULTS BLOCK
-        # Check if they hit the box               
-        hit = trial_reward[selected_chest]
-        result_text = '+$10' if hit else '-$10'        
+        # Check if they hit the box (and get the feedback screen and marker of the outcome)
+        hit, draw_feedback, feedback_marker = plan.outcomes[selected_chest]
         
-        # Create the fixation cross (pre results)
-        self.fixation_cross.draw()        
+        # Create the fixation cross (pre results) and keep it for the variable SOA
         self.win.callOnFlip(self.eeg_interface.eeg_send_marker, 'result_fixation_shown') # EEG marker
-        self.win.flip()
-        
-        # Variable SOA
-        core.wait(soa_time) 
-
-        # Show feedback
-        color = 'red'
-        background_color = '#ffdbdb'
-        if result_text == '+$10':
-            color = 'green'
-            background_color = '#d3ffd9'
-        self.result_background = visual.Rect(self.win, width=self.win.size[0], height=self.win.size[1], fillColor=background_color, lineColor=None)        
-        self.result_background.draw()                    
-        feedback = visual.TextStim(self.win, text=result_text, color=color, height=0.15, bold=True)        
-        feedback.draw()                
+        with span('soa', 'phase'):
+            self.scheduler.show('soa', soa_time, self.fixation_cross.draw)
+
+        # Show feedback (pre-rendered hit or miss screen)
         self.win.callOnFlip(self.eeg_interface.eeg_send_marker, 'feedback_shown') # EEG marker
-        self.win.flip()
-        core.wait(result_time)
+        self.win.callOnFlip(self.eeg_interface.eeg_send_marker, feedback_marker) # EEG marker (outcome, LSL only)
+        with span('feedback', 'phase'):
+            self.scheduler.show('feedback', result_time, draw_feedback)
+        if self.simulate:
+            self.responder.observe(selected_chest, hit)
 
-        # Accumulate the result 
-        result = calc_result(self, hit)
-        streak = self.trial_data[-1][7] + 1 if len(self.trial_data) > 0 and bool(hit) else hit 
-        self.trial_data.append([cond, trial_n, trial_reward, chest_latency, selected_chest, confidence_latency, selected_confidence, hit, result, streak])
-                
-        self.eeg_interface.eeg_send_marker('trial_end') # EEG marker1
-        
         ## ITI BLOCK
-        # Clear the screen 
-        core.wait(iti_time)
+        # The feedback stays on screen through the ITI: this flip redraws it, ends the feedback phase and sends the marker
+        self.win.callOnFlip(self.eeg_interface.eeg_send_marker, 'trial_end') # EEG marker
+        self.scheduler.start('iti', iti_time, draw_feedback)
+
+        # Update the accumulated result shown over the chests (re-rendering the text here keeps it out of the timed phases).
+        # It is rendered before the trial is stored, so its rebuild is counted in the row of this trial.
+        with span('update_total', 'iti'):
+            self.set_text(self.stimuli['total'], '$' + str(self.trial_data.total + (10 if hit else -10)))
+        with span('save_trial', 'iti'):
+            # Requested and achieved duration (ms) of the fixation, SOA and feedback phases, and their dropped frames
+            timed_phases = [self.scheduler.phases[phase] for phase in ['fixation', 'soa', 'feedback']]
+            timing = [round(t * 1000, 1) for phase in timed_phases for t in phase[:2]]
+            dropped_frames = sum(phase[2] for phase in timed_phases)
+            # Store the trial (this accumulates the result and the streak) and queue its row for the results file
+            row = self.trial_data.add(cond, trial_n, trial_reward, chest_latency, selected_chest, confidence_latency, int(selected_confidence), 
+                                      hit, self.stim_rebuilds, timing, dropped_frames)
+            self.results_writer.write(row)
+        # In real-time mode the garbage of the trial is only collected here
+        with span('gc_collect', 'iti'):
+            self.realtime_mode.collect()
+        # The rest of the ITI, minus the frames this work took (it is only longer if the work takes more than the ITI)
+        self.scheduler.hold(catch_up=True)
+
+    def preload_stimuli(self):
+        # Stimuli are cached by type and parameters, and images are decoded only once per asset path
+        self.stim_cache = {}
+        self.stim_rebuilds = 0
+        self.stimuli = {}
+        
+        # Fixation cross
+        self.fixation_cross = self.get_stim(visual.TextStim, text='+', color='black', height=0.2)
+        
+        # Chests and arrow keys
+        self.stimuli['chests'] = [self.get_stim(visual.ImageStim, image='assets/chest_2.png', size=0.3, pos=((i - 1) * 0.6, 0)) for i in range(3)]
+        self.stimuli['arrows'] = [self.get_stim(visual.ImageStim, image='assets/key_left.png', pos=(-0.6, -0.3)),
+                                  self.get_stim(visual.ImageStim, image='assets/key_down.png', pos=(0, -0.3)),
+                                  self.get_stim(visual.ImageStim, image='assets/key_right.png', pos=(0.6, -0.3))]
+        # Accumulated result, shown over the middle chest (its text is updated during the ITI)
+        self.stimuli['total'] = self.get_stim(visual.TextStim, text='$0', color='black', height=0.08, pos=(0, 0.75))
+        
+        # Confidence scale
+        confidence_text = f'¿Cuán seguro estás de que vas a ganar?'
+        confidence_levels = ['Bastante', 'Algo', 'Poco', 'Nada']
+        initial_x = -0.4 * (len(confidence_levels) - 1) / 2 # Center the scale
+        self.stimuli['confidence_instructions'] = self.get_stim(visual.TextStim, text=confidence_text, color='black', height=0.08, wrapWidth=1.7, pos=(0, 0.4))
+        self.stimuli['confidence_levels'] = [self.get_stim(visual.TextStim, text=level, color='black', height=0.08, pos=(initial_x + i * 0.4, 0)) 
+                                             for i, level in enumerate(confidence_levels)]
+        self.stimuli['confidence_keys'] = [self.get_stim(visual.ImageStim, image=f'assets/key_{i + 1}.png', pos=(initial_x + i * 0.4, -0.3)) 
+                                           for i in range(len(confidence_levels))]
+        
+        # Feedback screens, indexed by hit (0: miss, 1: hit)
+        width, height = int(self.win.size[0]), int(self.win.size[1])
+        self.stimuli['feedback_background'] = [self.get_stim(visual.Rect, width=width, height=height, fillColor='#ffdbdb', lineColor=None),
+                                               self.get_stim(visual.Rect, width=width, height=height, fillColor='#d3ffd9', lineColor=None)]
+        self.stimuli['feedback_text'] = [self.get_stim(visual.TextStim, text='-$10', color='red', height=0.15, bold=True),
+                                         self.get_stim(visual.TextStim, text='+$10', color='green', height=0.15, bold=True)]
+        # Each feedback screen is rendered once into a single image, so showing it is one texture draw
+        self.stimuli['feedback'] = [self.get_stim(visual.BufferImageStim, stim=(background, text)) 
+                                    for background, text in zip(self.stimuli['feedback_background'], self.stimuli['feedback_text'])]
+    
+    def make_session_plan(self, conditions=None):
+        # Prepare every trial of this part before the first one starts, so the trial loop only indexes this plan: its 
+        # rewards, its SOA and, for each chest, the outcome, the draw function of the feedback screen and the outcome marker.
+        # The SOAs are drawn in the order the trials run. Tools that run other blocks (e.g. benchmarks running the reverse
+        # learning trials in part 1) pass the conditions they run.
+        trials = {'learn': self.learn_trial, 'refresh': self.refresh_trials, 'reverse': self.reverse_trial}
+        if self.experiment_part == 1:
+            trials['test'] = self.test_trial
+        if conditions is None:
+            conditions = self.part_conditions[self.experiment_part]
+        schedules = {cond: trials[cond] for cond in conditions}
+        soas = iter(self.rng.uniform(1, 4, sum(len(trials) for trials in schedules.values())).tolist())
+        outcomes = [(0, self.stimuli['feedback'][0].draw, 'feedback_miss'), 
+                    (1, self.stimuli['feedback'][1].draw, 'feedback_hit')]
+        self.plan = {}
+        for cond, trials in schedules.items():
+            self.plan[cond] = [TrialPlan(reward, next(soas), tuple(outcomes[hit] for hit in reward)) for reward in trials]
+    
+    def decode_images(self, paths):
+        # Decode the image files (this doesn't need the window, so it can run in a background thread)
+        from PIL import Image
+        images = {}
+        for path in paths:
+            images[path] = Image.open(path)
+            images[path].load()
+        return images
+
+    def get_stim(self, stim_class, **params):
+        # Return the cached stimulus for these parameters, creating it only the first time. stim_rebuilds counts the stimuli
+        # created and re-rendered by the task (a proxy of the texture work: it is not a count of the GL uploads)
+        key = (stim_class.__name__, tuple(sorted(params.items())))
+        if key not in self.stim_cache:
+            if 'image' in params and not self.simulate:
+                # Decode each asset once, even if several stimuli share it
+                if params['image'] not in self.image_cache:
+                    self.image_cache.update(self.decode_images([params['image']]))
+                params['image'] = self.image_cache[params['image']]
+            self.stim_cache[key] = self.make_stim(stim_class, **params)
+            self.stim_rebuilds += 1
+        return self.stim_cache[key]
+    
+    def make_stim(self, stim_class, **params):
+        # Without a display (simulation) the stimuli only keep their parameters
+        if self.simulate:
+            return NullStim(self.win, **params)
+        return stim_class(self.win, **params)
+    
+    def set_text(self, stim, text):
+        # Changing the text of a TextStim re-renders its texture, so only do it when the text actually changes
+        if stim.text != text:
+            stim.text = text
+            self.stim_rebuilds += 1
 
     def draw_chests(self):
-        # Create the chest images
-        chests = []
-        for i in range(3):
-            image = Image.open('assets/chest_2.png')
-            chest = visual.ImageStim(self.win, image=image, size=0.3)
-            chest.pos = ((i - 1) * 0.6, 0)
-            chests.append(chest)
-            
-        # Create the arrow images
-        arrows = []
-        arrow_left = visual.ImageStim(self.win, image='assets/key_left.png')
-        arrow_left.pos = (-0.6, -0.3)
-        arrows.append(arrow_left)
-
-        arrow_down = visual.ImageStim(self.win, image='assets/key_down.png')
-        arrow_down.pos = (0, -0.3)
-        arrows.append(arrow_down)
-
-        arrow_right = visual.ImageStim(self.win, image='assets/key_right.png')
-        arrow_right.pos = (0.6, -0.3)
-        arrows.append(arrow_right)
-
-        # Draw the chests
-        for i, chest in enumerate(chests):
+        # Draw the chests, the accumulated result over the middle chest and the arrows
+        for chest in self.stimuli['chests']:
             chest.draw()
-            # Draw the accumulated result over the middle chest
-            if i == 1:
-                result = '$0'
-                if self.trial_data and len(self.trial_data) > 0:
-                    result = '$' + str(self.trial_data[-1][8])
-                text = visual.TextStim(self.win, text=result, color='black', height=0.08)
-                text.pos = (0, 0.75)
-                text.draw()            
-            
-        # Draw the arrows
-        for arrow in arrows:
+        self.stimuli['total'].draw()
+        for arrow in self.stimuli['arrows']:
             arrow.draw()
 
     def draw_confidence_scale(self):
-        # Define confidence levels         
-        confidence_text = f'¿Cuán seguro estás de que vas a ganar?'
-        confidence_levels = ['Bastante', 'Algo', 'Poco', 'Nada']
-        instructions = visual.TextStim(self.win, text=confidence_text, color='black', height=0.08, wrapWidth=1.7)
-        instructions.pos = (0, 0.4)        
-
-        # Draw confidence stims and images
-        confidence_stims = []
-        confidence_images = []
-        initial_x = -0.4 * (len(confidence_levels) - 1) / 2 # Center the scale
-        for i, level in enumerate(confidence_levels):
-            # Draw the confidence levels
-            confidence_stim = visual.TextStim(self.win, text=level, color='black', height=0.08)
-            confidence_stim.pos = (initial_x + i * 0.4, 0)
-            confidence_stims.append(confidence_stim)
-            # Draw the confidence images
-            image = visual.ImageStim(self.win, image=f'assets/key_{i + 1}.png')
-            image.pos = (initial_x + i * 0.4, -0.3)
-            confidence_images.append(image)            
-        # Draw the instruction and confidence levels
-        instructions.draw()            
-        for stim in confidence_stims:
+        # Draw the instruction, the confidence levels and their keys
+        self.stimuli['confidence_instructions'].draw()
+        for stim in self.stimuli['confidence_levels']:
             stim.draw()
-        for image in confidence_images:
+        for image in self.stimuli['confidence_keys']:
             image.draw()
 
-    def save_metadata(self, data):
-        # Create the folder if it doesn't exist
-        results_dir = os.path.dirname(self.metadata_file)
-        if not os.path.exists(results_dir):
-            os.makedirs(results_dir)
-        # Save the results:
-        with open(self.metadata_file, 'a') as f:
-            learn_list = [list(sublist) for sublist in data[1]] 
-            reverse_list = [list(sublist) for sublist in data[4]] 
-            f.write("learn_reward;learn_trials;refresh_trials;reverse_reward;reverse_trials\n")
-            f.write(f"{data[0]};{learn_list};{data[2]};{data[3]};{reverse_list}\n")
+    def save_metadata(self, schedule):
+        # Save the schedule for part 2 (an existing schedule is never overwritten)
+        save_schedule(self.schedule_file, schedule)
 
     def read_metadata(self):
-        # Check if the file exists
-        if not os.path.exists(self.metadata_file):
-            return None
-
-        # Open the file for reading
-        with open(self.metadata_file, 'r') as f:
-            # Read the first line (header)
-            header = f.readline().strip().split(';')
-            
-            # Read the second line (data)
-            data = f.readline().strip()
-            data_line = [eval(item) for item in data.split(';')]
-
-            # Return a list containing the four saved values
-            return data_line
+        # Schedules saved in the previous text format are converted the first time they are read
+        if not os.path.exists(self.schedule_file) and os.path.exists(self.metadata_file):
+            convert_metadata(self.metadata_file, self.schedule_file)
+        return load_schedule(self.schedule_file)
 
+    def completed_trials(self, cond):
+        # Trials of this condition already saved (when resuming an interrupted part)
+        return self.trial_data.counts[cond]
 
     def save_results(self):
-        # Create the folder if it doesn't exist
-        results_dir = os.path.dirname(self.results_file)
-        if not os.path.exists(results_dir):
-            os.makedirs(results_dir)
-        # Save the results:
-        with open(self.results_file, 'a') as f:
-            f.write("cond;trial_n;trial_setup;chest_latency_ms;chest_sel;confidence_latency_ms;confidence_sel;hit;result;streak\n")
-            for i, data in enumerate(self.trial_data):
-                f.write(f"{data[0]};{data[1]};{data[2]};{data[3]};{data[4]};{data[5]};{data[6]};{data[7]};{data[8]};{data[9]}\n")          
+        # The rows are already streamed to the results file, write the pending ones and close it
+        self.results_writer.close()
+        # Typed columnar copy for analysis
+        save_results_array(os.path.splitext(self.results_file)[0] + '.npy', self.trial_data.array())
+
+    def save_frame_report(self):
+        # Save the dropped frames per condition (of every trial of the part so far) and the frame intervals of this run
+        # next to the results file
+        base = self.run_base
+        trials = self.trial_data.array()
+        with open(base + '_frames.txt', 'w') as f:
+            f.write(f"frame_ms;{round(self.scheduler.frame_dur * 1000, 3)}\n")
+            f.write("cond;trials;trials_with_drops;dropped_frames\n")
+            for cond in self.trial_data.counts:
+                dropped = trials['dropped_frames'][trials['cond'] == cond]
+                f.write(f"{cond};{len(dropped)};{np.count_nonzero(dropped)};{dropped.sum()}\n")
+        np.savetxt(base + '_frame_intervals.txt', self.scheduler.frame_intervals() * 1000, fmt='%.3f')
+        if self.tracer.enabled:
+            self.tracer.save(base + '_trace.json', base + '_trace.txt')
+        if not self.simulate:
+            print(f"Overall, {self.scheduler.n_dropped} frames were dropped")
+            if self.realtime_mode.enabled:
+                print(f"Real-time mode: {self.realtime_mode.report()}")
+
+def simulate_session(subject_id, experiment_condition, responder, results_dir='results_sim', seed_value=None):
+    # Run part 1 and part 2 of a session with a synthetic participant and return the trials of both parts (TrialStore).
+    # The subject must be new in results_dir: the task would resume its earlier results instead of simulating them.
+    if os.path.exists(os.path.join(results_dir, subject_id)):
+        raise FileExistsError(f"{results_dir} already has results of {subject_id}, simulate into another folder")
+    trial_data = []
+    for experiment_part in [1, 2]:
+        task = MonetaryIncentiveDelayTask(subject_id, experiment_condition, experiment_part, responder, results_dir, seed_value)
+        task.run()
+        trial_data.append(task.trial_data)
+    return trial_data
+
+def simulate_sessions(n_sessions, results_dir='results_sim', alpha=0.3, beta=5.0):
+    # Simulate many sessions and print the rewarded choices per condition and the earnings. Every call saves its sessions
+    # to a new folder in results_dir (returned), so no earlier simulation is ever resumed.
+    os.makedirs(results_dir, exist_ok=True)
+    results_dir = tempfile.mkdtemp(prefix=time.strftime('%Y%m%d_%H%M%S_'), dir=results_dir)
+    rewarded = {}
+    earnings = []
+    for i in range(n_sessions):
+        responder = QLearningResponder(alpha, beta, seed=i)
+        parts = simulate_session(f"sim{i:05d}", ['A', 'B'][i % 2], responder, results_dir, seed_value=i + 1)
+        for trials in [part.array() for part in parts]:
+            for cond in dict.fromkeys(trials['cond'].tolist()):
+                rewarded.setdefault(cond, []).extend(trials['hit'][trials['cond'] == cond].tolist())
+        earnings.append(parts[0].total + parts[1].total)
+    for cond, hits in rewarded.items():
+        print(f"{cond}: {round(100 * np.mean(hits), 1)}% rewarded choices over {len(hits)} trials")
+    print(f"Mean earnings: ${round(float(np.mean(earnings)), 1)}")
+    print(f"Results saved to {results_dir}")
+    return results_dir
 
 if __name__ == "__main__": 
-    # Request any relevant information needed:
-    dlg = gui.Dlg(title="Información (MID)")
-    dlg.addText("Por favor, ingresa ID, condición y parte del sujeto:")
-    dlg.addField("Sujeto: ", "s")
-    dlg.addField('Condición:', choices=["A", "B"])
-    dlg.addField('Parte:', choices=["1", "2"])
-    data = dlg.show()
+    # python mid.py ... --trace: save a trace of the trials at the end of each part (see Tracer)
+    MonetaryIncentiveDelayTask.trace = '--trace' in sys.argv
+    # python mid.py ... --realtime [--cpu <n>]: real-time mode during the trial blocks (see RealtimeMode)
+    MonetaryIncentiveDelayTask.realtime = '--realtime' in sys.argv
+    if '--cpu' in sys.argv:
+        MonetaryIncentiveDelayTask.realtime_cpu = int(sys.argv[sys.argv.index('--cpu') + 1])
+    if len(sys.argv) > 2 and sys.argv[1] == '--simulate':
+        # python mid.py --simulate <n_sessions>
+        simulate_sessions(int(sys.argv[2]))
+        sys.exit()
+    if len(sys.argv) > 2 and sys.argv[1] == '--generate-schedules':
+        # python mid.py --generate-schedules <n_subjects or file with one subject ID per line> [results_dir] [seed]
+        if sys.argv[2].isdigit():
+            subject_ids = cohort_subject_ids(int(sys.argv[2]))
+        else:
+            with open(sys.argv[2]) as f:
+                subject_ids = [line.strip() for line in f if line.strip()]
+        generate_cohort(subject_ids, *sys.argv[3:4], *[int(seed) for seed in sys.argv[4:5]])
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == '--convert-metadata':
+        # python mid.py --convert-metadata [results_dir]
+        convert_metadata_tree(*sys.argv[2:3])
+        sys.exit()
+        
+    # PsychoPy is only imported on the main thread (importing it from two threads at once, or starting pyglet off the 
+    # main thread, isn't safe). The rest of it is imported by the task, once the dialog is closed.
+    from psychopy import gui
+    
+    # Request any relevant information needed (again, with the assigned condition first, if the condition chosen isn't 
+    # the one of the subject's schedule or cohort assignment):
+    subject_field, conditions = "s", ["A", "B"]
+    while True:
+        dlg = gui.Dlg(title="Información (MID)")
+        dlg.addText("Por favor, ingresa ID, condición y parte del sujeto:")
+        dlg.addField("Sujeto: ", subject_field)
+        dlg.addField('Condición:', choices=conditions)
+        dlg.addField('Parte:', choices=["1", "2"])
+        dlg.addField('Marcadores EEG:', choices=["RCS", "LSL"])
+        data = startup_timer.time('dialog', dlg.show)
+        condition = assigned_condition(data[0]) if dlg.OK else None
+        if condition is None or condition == data[1]:
+            break
+        warning = gui.Dlg(title="Condición")
+        warning.addText(f"El sujeto {data[0]} tiene asignada la condición {condition}, no la {data[1]}.")
+        warning.show()
+        subject_field, conditions = data[0], [condition] + [c for c in ["A", "B"] if c != condition]
     if dlg.OK:
         subject_id = data[0]
         exp_condition = data[1]
         experiment_part = int(data[2])
-        task = MonetaryIncentiveDelayTask(subject_id, exp_condition, experiment_part)
-        task.run()
\ No newline at end of file
+        marker_backend = data[3].lower()
+        task = MonetaryIncentiveDelayTask(subject_id, exp_condition, experiment_part, marker_backend=marker_backend)
+        task.run()
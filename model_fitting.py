@@ -0,0 +1,172 @@
+"""
+Q-learning fits of the MID choices: grid search, multi-start optimization and parameter recovery.
+
+The model is the one of QLearningResponder in mid.py: Q-values learnt with a Rescorla-Wagner update (learning rate
+alpha, starting at 0.5) and a softmax policy (inverse temperature beta) over the three chests, along the learning,
+refresh and reverse learning trials of a session.
+
+Each subject is first fitted with the grid search of analysis.py (all subjects and grid points in batched NumPy), and
+the best grid point is refined with scipy.optimize (L-BFGS-B) from it and from random starting points. Subjects are
+optimized in chunks in a process pool, and every evaluation of the likelihood computes its gradient in the same
+batched call (the point and its two neighbours are three parameter sets of q_learning_loglik).
+
+Parameter recovery simulates agents with known alpha and beta on schedules from generate_trials, fits them and
+reports how well the parameters are recovered:
+
+    python model_fitting.py [results_dir] [--starts 8] [--workers N]
+    python model_fitting.py --recovery 200 [--seed 0] [--min-r 0.7]
+"""
+import os, sys, time, argparse
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from mid import generate_trials, MonetaryIncentiveDelayTask
+from analysis import load_trials, session_arrays, q_learning_loglik, grid_search
+
+# Conditions of a session in the order they run (part 1: learning, part 2: refresh and reverse learning)
+SESSION_ORDER = ['learn', 'refresh', 'reverse']
+# Limits of the optimization, which runs on logit(alpha) and log(beta)
+ALPHA_BOUNDS = (0.001, 0.999)
+BETA_BOUNDS = (0.01, 100.0)
+
+def to_params(x):
+    # alpha and beta of optimization points (..., 2)
+    return 1 / (1 + np.exp(-x[..., 0])), np.exp(x[..., 1])
+
+def from_params(alpha, beta):
+    return np.stack([np.log(alpha / (1 - alpha)), np.log(beta)], axis=-1)
+
+def negative_loglik(x, choices, rewards, mask, step=1e-6):
+    # Negative log-likelihood of one subject at x and its gradient (forward differences), in one batched evaluation
+    alpha, beta = to_params(x + np.vstack([np.zeros(2), step * np.eye(2)]))
+    loglik = -q_learning_loglik(choices[None], rewards[None], mask[None], alpha, beta)[0]
+    return loglik[0], (loglik[1:] - loglik[0]) / step
+
+def optimize_subjects(choices, rewards, mask, starts):
+    """
+    Best optimization of each subject over its starting points.
+
+        choices, rewards, mask (array): (n_subjects, n_trials), see analysis.session_arrays.
+        starts (array): Starting points (n_subjects, n_starts, 2) of logit(alpha) and log(beta).
+
+    Returns the alpha, beta and log-likelihood of each subject, and how many of its starts converged.
+    """
+    from scipy.optimize import minimize
+    bounds = from_params(np.array(ALPHA_BOUNDS), np.array(BETA_BOUNDS)).T
+    fits = np.empty((len(choices), 4))
+    for i in range(len(choices)):
+        results = [minimize(negative_loglik, x0, args=(choices[i], rewards[i], mask[i]), jac=True,
+                            method='L-BFGS-B', bounds=bounds) for x0 in starts[i]]
+        best = min(results, key=lambda result: result.fun)
+        fits[i] = [*to_params(best.x), -best.fun, sum(result.success for result in results)]
+    return fits
+
+def multi_start_fit(choices, rewards, mask, n_starts=8, seed=None, workers=None, chunk_size=20):
+    """
+    Maximum likelihood alpha and beta of every subject. The first start is the best point of the grid search, the
+    others are drawn uniformly in logit(alpha) and log(beta) within the bounds.
+
+        choices, rewards, mask (array): (n_subjects, n_trials), see analysis.session_arrays.
+        n_starts (int): Starting points per subject.
+        seed (int): Seed of the random starting points.
+        workers (int): Processes of the pool (one per CPU by default).
+        chunk_size (int): Subjects per task of the pool.
+
+    Returns a DataFrame with the grid and the optimized fits (one row per subject, in the order of the arrays).
+    """
+    grid_alpha, grid_beta, grid_loglik = grid_search(choices, rewards, mask)
+    low, high = from_params(np.array(ALPHA_BOUNDS), np.array(BETA_BOUNDS))
+    starts = np.random.default_rng(seed).uniform(low, high, (len(choices), n_starts, 2))
+    starts[:, 0] = from_params(np.clip(grid_alpha, *ALPHA_BOUNDS), grid_beta)
+    chunks = [slice(i, i + chunk_size) for i in range(0, len(choices), chunk_size)]
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(optimize_subjects, *zip(*[(choices[c], rewards[c], mask[c], starts[c]) for c in chunks])))
+    fits = np.concatenate(results) if results else np.empty((0, 4))
+    return pd.DataFrame({'grid_alpha': grid_alpha, 'grid_beta': grid_beta, 'grid_loglik': grid_loglik,
+                         'alpha': fits[:, 0], 'beta': fits[:, 1], 'loglik': fits[:, 2],
+                         'converged_starts': fits[:, 3].astype(int), 'n_trials': mask.sum(axis=1)})
+
+def fit_results(results_dir='results', **params):
+    # Multi-start fits of every subject under results_dir, with the BIC
+    subjects, choices, rewards, mask = session_arrays(load_trials(results_dir))
+    fits = multi_start_fit(choices, rewards, mask, **params).set_index(pd.Index(subjects, name='subject'))
+    fits['bic'] = 2 * np.log(fits['n_trials']) - 2 * fits['loglik']
+    return fits
+
+def session_outcomes(schedule):
+    # Reward (1) or loss (0) of each chest (n_subjects, n_trials, 3) on every trial of a session, in the order they run
+    return np.concatenate([schedule[f"{cond}_trials"] for cond in SESSION_ORDER], axis=1)
+
+def simulate_agents(outcomes, alpha, beta, seed=None, q0=0.5):
+    """
+    Choices of Q-learning agents (like QLearningResponder) on the chest outcomes of their sessions, all agents at once.
+
+        outcomes (array): (n_agents, n_trials, 3), see session_outcomes.
+        alpha, beta (array): Learning rate and inverse temperature of each agent.
+
+    Returns the choices and rewards (n_agents, n_trials) and the mask of the trials, as analysis.session_arrays.
+    """
+    rng = np.random.default_rng(seed)
+    n_agents, n_trials, n_chests = outcomes.shape
+    alpha, beta = np.asarray(alpha, dtype=float), np.asarray(beta, dtype=float)[:, None]
+    agents = np.arange(n_agents)
+    q = np.full((n_agents, n_chests), q0)
+    choices = np.zeros((n_agents, n_trials), dtype=int)
+    rewards = np.zeros((n_agents, n_trials))
+    # Softmax choices by inverse transform sampling: the first chest whose cumulative probability exceeds a uniform draw
+    draws = rng.random((n_agents, n_trials, 1))
+    for t in range(n_trials):
+        p = np.cumsum(np.exp(beta * (q - q.max(axis=1, keepdims=True))), axis=1)
+        choices[:, t] = np.minimum((draws[:, t] * p[:, -1:] >= p).sum(axis=1), n_chests - 1)
+        rewards[:, t] = outcomes[agents, t, choices[:, t]]
+        q[agents, choices[:, t]] += alpha * (rewards[:, t] - q[agents, choices[:, t]])
+    return choices, rewards, np.ones((n_agents, n_trials), dtype=bool)
+
+def parameter_recovery(n_agents, seed=None, alpha_range=(0.05, 0.95), beta_range=(0.5, 20.0), **params):
+    """
+    Simulate agents with known parameters (alpha uniform, beta log-uniform in their ranges) on schedules of
+    generate_trials, fit them with multi_start_fit and compare the fitted parameters to the true ones.
+
+    Returns the fits with the true parameters, and the correlations (alpha and log beta) and median absolute errors.
+    """
+    schedule_seed, agent_seed, start_seed = np.random.SeedSequence(seed).spawn(3)
+    schedule = generate_trials(n_agents, schedule_seed, max_run_length=MonetaryIncentiveDelayTask.max_run_length)
+    rng = np.random.default_rng(agent_seed)
+    true_alpha = rng.uniform(*alpha_range, n_agents)
+    true_beta = np.exp(rng.uniform(*np.log(beta_range), n_agents))
+    choices, rewards, mask = simulate_agents(session_outcomes(schedule), true_alpha, true_beta, rng)
+    fits = multi_start_fit(choices, rewards, mask, seed=start_seed, **params)
+    fits.insert(0, 'true_beta', true_beta)
+    fits.insert(0, 'true_alpha', true_alpha)
+    summary = {'r_alpha': np.corrcoef(true_alpha, fits['alpha'])[0, 1],
+               'r_log_beta': np.corrcoef(np.log(true_beta), np.log(fits['beta']))[0, 1],
+               'median_error_alpha': np.median(np.abs(fits['alpha'] - true_alpha)),
+               'median_error_beta': np.median(np.abs(fits['beta'] - true_beta))}
+    return fits, summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('results_dir', nargs='?', default='results')
+    parser.add_argument('--output', default=None, help='File for the fits (results_dir/analysis/q_learning_multistart.txt by default)')
+    parser.add_argument('--starts', type=int, default=8, help='Starting points per subject')
+    parser.add_argument('--workers', type=int, default=None, help='Processes (one per CPU by default)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--recovery', type=int, default=None, metavar='N_AGENTS', help='Run a parameter recovery with simulated agents')
+    parser.add_argument('--min-r', type=float, default=0.7, help='Recovery fails (exit status 1) below this correlation')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.recovery is not None:
+        fits, summary = parameter_recovery(args.recovery, args.seed, n_starts=args.starts, workers=args.workers)
+        print(f"{args.recovery} agents simulated and fitted in {time.perf_counter() - start:.2f} s")
+        for name, value in summary.items():
+            print(f"{name}: {value:.3f}")
+        if args.output:
+            fits.to_csv(args.output, sep=';')
+        sys.exit(0 if min(summary['r_alpha'], summary['r_log_beta']) >= args.min_r else 1)
+
+    fits = fit_results(args.results_dir, n_starts=args.starts, seed=args.seed, workers=args.workers)
+    output = args.output or os.path.join(args.results_dir, 'analysis', 'q_learning_multistart.txt')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    fits.to_csv(output, sep=';')
+    print(f"{len(fits)} subjects fitted in {time.perf_counter() - start:.2f} s, saved to {output}")
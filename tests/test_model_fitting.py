@@ -0,0 +1,50 @@
+import os, sys
+import numpy as np
+from scipy.optimize import check_grad
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import model_fitting
+from analysis import q_learning_loglik
+from mid import generate_trials
+
+def fixed_session():
+    # Choices of two agents on a seeded schedule (the second one with its last 20 trials masked out, as padding)
+    outcomes = model_fitting.session_outcomes(generate_trials(2, 11))
+    choices, rewards, mask = model_fitting.simulate_agents(outcomes, [0.3, 0.6], [5.0, 2.0], seed=1)
+    mask[1, -20:] = False
+    return choices, rewards, mask
+
+def reference_loglik(choices, rewards, mask, alpha, beta, q0=0.5):
+    # Trial by trial log-likelihood of one subject (softmax over Q-values, Rescorla-Wagner update of the chosen chest)
+    q = np.full(3, q0)
+    loglik = 0.0
+    for choice, reward, valid in zip(choices, rewards, mask):
+        if valid:
+            loglik += beta * q[choice] - np.log(np.exp(beta * q).sum())
+            q[choice] += alpha * (reward - q[choice])
+    return loglik
+
+def test_negative_loglik_matches_q_learning_loglik():
+    choices, rewards, mask = fixed_session()
+    for x in [np.array([0.0, 1.0]), np.array([-2.0, 2.5]), np.array([1.5, -0.5])]:
+        alpha, beta = model_fitting.to_params(x)
+        expected = q_learning_loglik(choices, rewards, mask, np.array([alpha]), np.array([beta]))[:, 0]
+        for i in range(len(choices)):
+            value, _ = model_fitting.negative_loglik(x, choices[i], rewards[i], mask[i])
+            assert np.isclose(value, -expected[i])
+            assert np.isclose(value, -reference_loglik(choices[i], rewards[i], mask[i], alpha, beta))
+
+def test_negative_loglik_gradient():
+    choices, rewards, mask = fixed_session()
+    for x in [np.array([0.0, 1.0]), np.array([-2.0, 2.5]), np.array([1.5, -0.5])]:
+        for i in range(len(choices)):
+            args = (choices[i], rewards[i], mask[i])
+            gradient = model_fitting.negative_loglik(x, *args)[1]
+            error = check_grad(lambda x: model_fitting.negative_loglik(x, *args)[0],
+                               lambda x: model_fitting.negative_loglik(x, *args)[1], x)
+            assert error < 1e-4 * (1 + np.linalg.norm(gradient))
+
+def test_parameter_recovery():
+    fits, summary = model_fitting.parameter_recovery(60, seed=0, n_starts=2, workers=2)
+    assert len(fits) == 60
+    assert summary['r_alpha'] > 0.7
+    assert summary['r_log_beta'] > 0.7